@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+import numpy as np
+import argparse
+import itertools
+import json
+import os
+import platform
+import scipy
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from Average_power_spec_calc_v05 import make_options, run_report_file_name
+from Synthetic_helical_particles import generate_dataset
+
+
+parser = argparse.ArgumentParser(description="""
+Time Average_power_spec_calc_v05.py end to end and per stage over every combination of pad factor, oversample factor,
+number of workers and backend, on a star file or on a generated synthetic helical data set.
+Options that are not listed here (e.g. --half_plane 1 or --angle_bin 0.25) are passed on to the averaging script.
+                    """)
+parser.add_argument('-i', '--input_star', default=None, type=str, help="""
+input particle star file. Without it, a synthetic data set is generated in --data_dir (or in a temporary directory)
+                    """)
+parser.add_argument('-d', '--particle_dir', default=None, type=str, help='diretory of particle stack mrcs files')
+parser.add_argument('--data_dir', default=None, type=str, help="""
+directory of the synthetic data set. It is generated only if it has no particles.star yet, so it can be reused between benchmarks
+                    """)
+parser.add_argument('-n', '--n_particles', default=2000, type=int, help='number of synthetic particles')
+parser.add_argument('--box', default=128, type=int, help='box size of the synthetic particles in pixels')
+parser.add_argument('--psi', default='uniform', type=str, choices=['uniform', 'bimodal'], help='psi distribution of the synthetic particles')
+parser.add_argument('-p', '--pad_factor', default=[1], type=int, nargs='+', help='pad factors to time')
+parser.add_argument('-o', '--oversample_factor', default=[1], type=int, nargs='+', help='oversample factors to time')
+parser.add_argument('-j', '--processes', default=[4], type=int, nargs='+', help='Numbers of workers to time')
+parser.add_argument('--backends', default=['processes', 'threads'], type=str, nargs='+', choices=['processes', 'threads'],
+                    help='Backends to time')
+parser.add_argument('--repeat', default=3, type=int, help='Number of timed runs of every setting')
+parser.add_argument('--results', default=None, type=str, help='JSON file to write the results to')
+parser.add_argument('--compare', default=None, type=str, help="""
+results JSON file of an earlier benchmark. Settings that got slower by more than --tolerance are listed as regressions
+                    """)
+parser.add_argument('--tolerance', default=0.1, type=float, help='relative slow-down of the processing time counted as a regression')
+parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Average_power_spec_calc_v05.py'),
+                    type=str, help='averaging script to time')
+args, script_options = parser.parse_known_args()
+
+# the runs read a link to the star file in a temporary directory, so their outputs, run reports, the particle table
+# cache and checkpoints are written there instead of next to the real star file
+tmp_dir = tempfile.TemporaryDirectory()
+dataset = None
+if args.input_star is None:
+    data_dir = args.data_dir or os.path.join(tmp_dir.name, 'synthetic')
+    args.input_star = os.path.join(data_dir, 'particles.star')
+    if not os.path.isfile(args.input_star):
+        print(f'Generating {args.n_particles} synthetic particles of {args.box} pixels in {data_dir}')
+        generate_dataset(data_dir, n_particles=args.n_particles, box=args.box, psi_distribution=args.psi)
+    with open(os.path.join(data_dir, 'dataset.json')) as f:
+        dataset = json.load(f)
+star_link = os.path.join(tmp_dir.name, os.path.basename(args.input_star))
+os.symlink(os.path.abspath(args.input_star), star_link)
+command = [sys.executable, args.script, '-i', star_link, '--checkpoint_interval', '0', '--profile']
+if args.particle_dir is not None:
+    command += ['-d', args.particle_dir]
+command += script_options
+env = dict(os.environ, MPLBACKEND='Agg')
+
+
+def run_average(pad_factor, oversample_factor, backend, n_workers):
+    # returns the wall time of the whole script, the processing time from its run report and the report
+    start_time = time.time()
+    result = subprocess.run(command + ['-p', str(pad_factor), '-o', str(oversample_factor), '--backend', backend, '-j', str(n_workers)],
+                            env=env, capture_output=True, text=True)
+    wall_time = time.time() - start_time
+    if result.returncode != 0:
+        sys.exit(f'The averaging script failed with -p {pad_factor} -o {oversample_factor} --backend {backend} -j {n_workers}:\n'
+                 f'{result.stderr}')
+    with open(run_report_file_name(make_options(star_link, pad_factor=pad_factor))) as f:
+        report = json.load(f)
+    return wall_time, report['main_stages'].get('processing', 0), report
+
+
+def setting_key(result):
+    return (result['pad_factor'], result['oversample_factor'], result['backend'], result['processes'])
+
+
+# one untimed run parses the star file into the cache and brings the stacks into the page cache
+print('Warm-up run')
+run_average(args.pad_factor[0], args.oversample_factor[0], args.backends[0], args.processes[0])
+
+results = []
+print(f'{"pad":>4s} {"oversample":>10s} {"backend":>10s} {"workers":>8s} {"wall (s)":>10s} {"processing (s)":>15s} {"particles/s":>12s}')
+for pad_factor, oversample_factor, backend, n_workers in itertools.product(args.pad_factor, args.oversample_factor,
+                                                                          args.backends, args.processes):
+    runs = [run_average(pad_factor, oversample_factor, backend, n_workers) for _ in range(args.repeat)]
+    # the stage times are taken from the run with the median processing time
+    median_run = sorted(runs, key=lambda run: run[1])[len(runs)//2]
+    processing_time = median_run[1]
+    particle_count = median_run[2]['particles']
+    results.append({
+        'pad_factor': pad_factor,
+        'oversample_factor': oversample_factor,
+        'backend': backend,
+        'processes': n_workers,
+        'particles': particle_count,
+        'wall_time': float(np.median([run[0] for run in runs])),
+        'processing_time': processing_time,
+        'particles_per_second': particle_count/processing_time if processing_time > 0 else None,
+        'main_stages': median_run[2]['main_stages'],
+        'worker_stages': median_run[2]['worker_stages'],
+        'peak_rss_bytes': median_run[2]['peak_rss_bytes'],
+        'peak_worker_rss_bytes': median_run[2]['peak_worker_rss_bytes'],
+        'wall_times': [run[0] for run in runs],
+        'processing_times': [run[1] for run in runs],
+    })
+    particle_rate = particle_count/processing_time if processing_time > 0 else float('inf')
+    print(f'{pad_factor:4d} {oversample_factor:10d} {backend:>10s} {n_workers:8d} {results[-1]["wall_time"]:10.2f} '
+          f'{processing_time:15.2f} {particle_rate:12.0f}')
+    print('     worker stages (s): ' + ', '.join(f'{stage} {stage_time:.2f}' for stage, stage_time in median_run[2]['worker_stages'].items()))
+tmp_dir.cleanup()
+
+if args.results is not None:
+    with open(args.results, 'w') as f:
+        json.dump({
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'script': os.path.abspath(args.script),
+            'star_file': os.path.abspath(args.input_star),
+            'dataset': dataset,
+            'script_options': script_options,
+            'repeat': args.repeat,
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+                            'machine': platform.machine(), 'cpu_count': os.cpu_count()},
+            'results': results,
+        }, f, indent=1)
+    print(f'Saved the results to {args.results}')
+
+if args.compare is not None:
+    with open(args.compare) as f:
+        earlier = json.load(f)
+    if earlier.get('dataset') != dataset or earlier.get('script_options') != script_options:
+        print(f'Warning: {args.compare} was run on a different data set or with different options')
+    earlier_results = {setting_key(result): result for result in earlier['results']}
+    print(f'\nProcessing time compared with {args.compare} ({earlier.get("date")})')
+    regressions = 0
+    for result in results:
+        if setting_key(result) not in earlier_results:
+            continue
+        earlier_time = earlier_results[setting_key(result)]['processing_time']
+        change = result['processing_time']/earlier_time - 1 if earlier_time > 0 else 0
+        flag = 'REGRESSION' if change > args.tolerance else ''
+        regressions += bool(flag)
+        print(f'-p {result["pad_factor"]} -o {result["oversample_factor"]} --backend {result["backend"]} -j {result["processes"]}: '
+              f'{earlier_time:.2f} s -> {result["processing_time"]:.2f} s ({100*change:+.0f}%) {flag}')
+    print(f'{regressions} regression(s) beyond {100*args.tolerance:.0f}%')
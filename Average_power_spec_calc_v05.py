@@ -3,138 +3,1684 @@
 import mrcfile
 import numpy as np
 from scipy import ndimage
+import scipy.fft
 import matplotlib.pyplot as plt
-import glob
+import itertools
+import json
+import math
+import os
+import queue
 import re
+import sys
+import threading
+import time
 import argparse
 import multiprocessing
+import multiprocessing.pool
+from multiprocessing import shared_memory
+try:
+    import resource
+except ImportError:
+    # not available on Windows; the run report then has no peak memory
+    resource = None
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-r', '--rotate', default=-90, type=float, help="""
+# The averaging engine can be used from other scripts and from PyHI, e.g.
+#     options = make_options('particles.star', pad_factor=2, group_by='rlnClassNumber')
+#     star_table = load_star_table(options.input_star, table_columns(options))
+#     accumulator, ang_pix = average_particles(options, star_table)
+#     fft_average, rotated_average = accumulator.average(accumulator.groups()[0], options.half_plane)
+# Running the file as a script parses the command line and writes the averages with main().
+# Large data sets can be split over several nodes with --shard i/N; every shard writes its partial sums, and
+#     Average_power_spec_calc_v05.py merge particles_pad2_shard*of8_partial_sums.npz
+# writes the averages from them.
+
+
+class AveragingError(Exception):
+    pass
+
+
+def parse_size(size):
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if size[-1].upper() in units:
+        return int(float(size[:-1])*units[size[-1].upper()])
+    return int(size)
+
+
+def parse_shard(shard):
+    # 'i/N' -> (i, N), with shards numbered from 1 to N
+    match = re.fullmatch(r'(\d+)/(\d+)', shard)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f'{shard} is not of the form i/N with 1 <= i <= N')
+    return int(match.group(1)), int(match.group(2))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rotate', default=-90, type=float, help="""
 Rotate the paricle image by this angle.
 If the 2D class average from RELION is well aligned horizontally, set this value to -90.
 Otherwise, open the 2D class average in PyHI, adjust the rotate img parameter until the image is vertially aligned.
 Then set the -r to the value of the rotation angle.
-                    """)
-parser.add_argument('-i', '--input_star', required=1, type=str, help='input particle star file')
-parser.add_argument('-d', '--particle_dir', required=1, type=str, help='diretory of particle stack mrcs files')
-parser.add_argument('-p', '--pad_factor', default=1, type=int, help='pad 2D image with zeros by this factor')
-parser.add_argument('-o', '--oversample_factor', default=1, type=int, help='oversample FFT by this factor')
-parser.add_argument('-s', '--symmetrize', default=0, type=int, choices=[0, 1], help='Set to 1 to not symmetrize the power spectrum')
-#symmetrizing the power spectrum would mess things up if the particles are not perfectly aligned, making powwer spectrum look symmetric and vertical
-# although it is acutally not symmmetric
-parser.add_argument('-j', '--processes', default=4, type=int, help='Number of processes to use for parallel processing')
-args = parser.parse_args()
-
-star_file_name = args.input_star
-particle_stack_dir = args.particle_dir
-pad_factor = args.pad_factor
-oversample_factor = args.oversample_factor
-rotation_angle = args.rotate
-n_processes = args.processes
-
-output_mrc = star_file_name.split('.')[0]
-output_mrc = f'{output_mrc}_pad{pad_factor}_oversample{oversample_factor}_average_power_spec.mrc'
-
-particle_dic = {}
-total_particle_count = 0
-ang_pix = 1
-
-with open(star_file_name) as f:
-    for line in f.readlines():
-        if '_rlnAnglePsi ' in line:
-            angle_field_number = int(line.split()[1][1:]) - 1
-        if '_rlnImagePixelSize' in line:
-            ang_pix_field_number = int(line.split()[1][1:]) - 1
-        if 'opticsGroup1' in line:
-            ang_pix = float(line.split()[ang_pix_field_number])
-        elif '.mrc' in line:
-            tmp_name = re.search(r'@(.+\.mrc)s', line)
-            tmp_name = tmp_name.group(1)
-            mrc_base_name = tmp_name.split('/')[-1].split('.')[0]
-            rotation_angle = -float(line.split()[angle_field_number]) + args.rotate
-            for field in line.split():
-                if '@' in field:
-                    slice_number = int(field.split('@')[0]) - 1
-            if mrc_base_name not in particle_dic:
-                particle_dic[mrc_base_name] = []
-            particle_dic[mrc_base_name].append([slice_number, rotation_angle])
-            total_particle_count += 1
-
-
-def process_particle(args):
-    img, rotation_angle, pad_x, pad_y, oversample_factor = args
-    img_slice_padded = np.pad(img, ((pad_y, pad_y), (pad_x, pad_x)), mode='constant')
-    img_slice_padded = img_slice_padded.astype(np.float32)
-    img_slice_rotated = ndimage.rotate(img_slice_padded, rotation_angle, reshape=False)
-    fft_slice_amp = np.abs(np.fft.fftshift(np.fft.fft2(img_slice_rotated)))
-    if oversample_factor > 1:
-        fft_slice_amp = ndimage.zoom(fft_slice_amp, oversample_factor)
-    return fft_slice_amp, img_slice_rotated
-
-process_count = 0
-rotated_stack = 0
-fft_stack = 0
-particle_stack_files = particle_stack_dir + '/*.mrcs'
-for mrcs in glob.glob(particle_stack_files):
-    mrc_base_name = mrcs.split('/')[-1].split('.')[0]
-    if mrc_base_name in particle_dic:
-        print(f'\n{"*"*40}\nProcessing particles in {mrcs}...')
-        particles_selected = particle_dic[mrc_base_name]
-        with mrcfile.open(mrcs, permissive=True) as f:
-            img_data = f.data 
-            if img_data.ndim == 2:
-                img_data = img_data.reshape(1, img_data.shape[0], img_data.shape[1])
-            x_dim = img_data.shape[2]
-            y_dim = img_data.shape[1]
-            pad_x = int(x_dim*(pad_factor-1)/2)
-            pad_y = int(y_dim*(pad_factor-1)/2)
-
-        process_args = [
-            (img_data[i], rotation_angle, pad_x, pad_y, oversample_factor)
-            for i, rotation_angle in particles_selected
-        ]
+                        """)
+    parser.add_argument('-i', '--input_star', required=1, type=str, help='input particle star file')
+    parser.add_argument('-d', '--particle_dir', default=None, type=str, help="""
+diretory of particle stack mrcs files. If not given, the stacks are opened at the paths in the star file,
+relative to the current directory or to the directory of the star file.
+                        """)
+    parser.add_argument('-p', '--pad_factor', default=1, type=int, help='pad 2D image with zeros by this factor')
+    parser.add_argument('--fast_fft', '--fast-fft', default=0, type=int, choices=[0, 1], help="""
+Set to 1 to pad the 2D images a little further, to the next box size that is a product of small primes, so the FFTs stay fast
+for box sizes such as 450 or 486 pixels. The padding stays the same on both sides and the pixel size does not change;
+the output files are as many pixels larger.
+                        """)
+    parser.add_argument('-o', '--oversample_factor', default=[1], type=int, nargs='+', help="""
+oversample FFT by this factor. The average is oversampled once when it is written,
+so several factors (e.g. -o 1 2 4) can be written from one pass over the particles.
+                        """)
+    parser.add_argument('-s', '--symmetrize', default=0, type=int, choices=[0, 1], help='Set to 1 to not symmetrize the power spectrum')
+    #symmetrizing the power spectrum would mess things up if the particles are not perfectly aligned, making powwer spectrum look symmetric and vertical
+    # although it is acutally not symmmetric
+    parser.add_argument('-j', '--processes', default=4, type=int, help='Number of processes (or threads with --backend threads) to use for parallel processing')
+    parser.add_argument('--backend', default='processes', type=str, choices=['processes', 'threads'], help="""
+Run the workers as separate processes, or as threads of this process. Threads share the partial sums in memory
+instead of pickling them back, which helps with large boxes; the FFTs, reads and most of the rotation run in C code
+that releases the GIL.
+                        """)
+    parser.add_argument('--fft_workers', '--fft-workers', default=1, type=int, help='Number of threads each worker uses inside every batched FFT call')
+    parser.add_argument('-c', '--chunk_size', default=32, type=int, help='Number of particles sent to a process at a time')
+    parser.add_argument('-b', '--batch_size', default=16, type=int, help='Number of particles transformed together in one batched FFT call')
+    parser.add_argument('--read_ahead', '--read-ahead', default=2, type=int, help="""
+Number of particle batches each process reads ahead on a background thread while the current batch is transformed,
+so disk reads overlap with the FFTs. Set to 0 to read and transform in turn.
+                        """)
+    parser.add_argument('--angle_bin', '--angle-bin', default=0, type=float, help="""
+Group particles into rotation angle bins of this width (in degrees, e.g. 0.25) and rotate the sums of each bin once,
+by the bin centre, instead of every particle. This is an approximation: the amplitude sums are interpolated as
+amplitudes instead of rotating the particles before the FFT, which changes the noise floor of the power spectrum
+whatever the bin width. It suits quick surveys of large data sets.
+Set to 0 (default) to rotate every particle by its own angle.
+                        """)
+    parser.add_argument('--interp_order', '--interp-order', default=3, type=int, choices=range(6), help="""
+Order of the spline interpolation used to rotate the particles (and the angle bin sums): 1 (linear) is quick for
+previews, 3 (cubic, default) is the same interpolation as before. All particles of a batch are rotated together.
+                        """)
+    parser.add_argument('--half_plane', default=0, type=int, choices=[0, 1], help="""
+Set to 1 to use a real-input FFT and accumulate only the non-redundant half of the amplitude spectrum.
+The full power spectrum is rebuilt by Friedel symmetry when the output is written.
+                        """)
+    parser.add_argument('--precision', default='double', type=str, choices=['double', 'single'], help="""
+Precision of the partial sums and accumulators. The FFTs are always single precision; with single the sums are
+float32 as well, which halves the memory of the sums and of the results in flight.
+                        """)
+    parser.add_argument('--compensated', default=0, type=int, choices=[0, 1], help="""
+Set to 1 to add the partial sums into single precision accumulators with compensated (Kahan) summation,
+which keeps the totals of long runs close to double precision.
+                        """)
+    parser.add_argument('--apply_shifts', '--apply-shifts', default=1, type=int, choices=[0, 1], help="""
+Shift every particle by its rlnOriginXAngst/rlnOriginYAngst (or rlnOriginX/rlnOriginY in pixels) before it goes into
+the real-space average. The shifts are applied as phase ramps on the particle FFTs, so they cost one inverse FFT per batch;
+the power spectrum does not change with them. Set to 0 to ignore the origin shifts.
+                        """)
+    parser.add_argument('--realspace', default=1, type=int, choices=[0, 1], help='Set to 0 to skip the average rotated real-space image and only compute the power spectrum')
+    parser.add_argument('--variance', default=0, type=int, choices=[0, 1], help="""
+Set to 1 to also sum the squared amplitudes of every Fourier pixel and write the standard deviation of the particle
+amplitudes and an SNR map (average / standard deviation) next to the average power spectrum. Pixels with only noise
+have an SNR of about 1.9, reproducible layer-line peaks stand out above that. The squared sums are merged across workers,
+checkpoints and shards like the amplitude sums. They are kept in double precision even with --precision single,
+as the standard deviation comes from their difference to the squared amplitude sum.
+                        """)
+    parser.add_argument('--half_sets', '--half-sets', default=0, type=int, choices=[0, 1], help="""
+Set to 1 to also average the two half sets of the particles, split by rlnRandomSubset (or, for particles without it,
+by a hash of the star file row), and write their power spectra and a layer-line correlation curve between them.
+RELION keeps the overlapping segments of a filament in the same random subset, so use its split where there is one.
+                        """)
+    parser.add_argument('--bootstrap', default=0, type=int, help="""
+Number of bootstrap replicates of the average power spectrum. Every particle is added to each replicate with a
+Poisson(1) weight, from the same FFT as the average, and the replicates are written as one .mrcs stack
+                        """)
+    parser.add_argument('--bootstrap_seed', '--bootstrap-seed', default=0, type=int, help="""
+Seed of the bootstrap weights. The weights only depend on the seed and the star file row, so shards and resumed runs
+draw the same replicates
+                        """)
+    parser.add_argument('--group_by', '--group-by', default=None, type=str, help="""
+Average the particles separately for each value of this star file column (e.g. rlnClassNumber) in a single pass.
+The per-group power spectra are written as one .mrcs stack that can be paged through in PyHI.
+                        """)
+    parser.add_argument('--max_mem', '--max-mem', default=None, type=parse_size, help="""
+Stream the star file instead of loading all particles first, and keep the data in flight below this size
+(e.g. 4G; K, M, G and T suffixes are accepted). Memory use then no longer grows with the number of particles.
+The per-group accumulators of --group_by come on top of this.
+                        """)
+    parser.add_argument('--shard', default=None, type=parse_shard, help="""
+Process only shard i of N (e.g. --shard 3/8) of the star file rows and write their partial sums to a
+_shard{i}of{N}_partial_sums.npz file instead of the averages. The rows are dealt out to the shards in blocks of 1000
+rows, or of rows/N rows (down to single rows) when the star file has fewer than N*1000 rows, so every shard gets its
+share; with --max_mem the image names are read once more to count the rows.
+The shards can run on different nodes at the same time; combine them with "Average_power_spec_calc_v05.py merge *_partial_sums.npz".
+                        """)
+    parser.add_argument('--checkpoint_interval', default=600, type=float, help='Write a checkpoint of the partial sums every this many seconds. Set to 0 to disable')
+    parser.add_argument('--resume', action='store_true', help='Continue from the checkpoint written by an earlier, interrupted run with the same parameters')
+    parser.add_argument('--profile', action='store_true', help="""
+Time every stage of the run (star file parsing, chunking, reads, padding, rotation, FFT, summing, origin shifts, accumulation,
+oversampling and writing) and write them with the throughput, per-worker utilisation and peak memory
+to a JSON run report next to the output files.
+                        """)
+    return parser
+
+
+def make_options(input_star, **overrides):
+    # the command line defaults for input_star, with any option replaced by keyword, e.g. make_options('p.star', pad_factor=2)
+    options = build_parser().parse_args(['-i', input_star])
+    for name, value in overrides.items():
+        if not hasattr(options, name):
+            raise AveragingError(f'Unknown option {name}')
+        setattr(options, name, value)
+    return options
+
+
+def output_base(options):
+    # only the extension of the file name is dropped, so dots in directory names are kept
+    return os.path.splitext(options.input_star)[0]
+
+
+def shard_suffix(options):
+    # the checkpoints, partial sums and run reports of the shards of a star file get their own names
+    return f'_shard{options.shard[0]}of{options.shard[1]}' if options.shard is not None else ''
+
+
+def checkpoint_file_name(options):
+    return f'{output_base(options)}_pad{options.pad_factor}{shard_suffix(options)}_checkpoint.npz'
+
+
+def partial_sums_file_name(options):
+    return f'{output_base(options)}_pad{options.pad_factor}{shard_suffix(options)}_partial_sums.npz'
+
+
+def run_report_file_name(options):
+    return f'{output_base(options)}_pad{options.pad_factor}{shard_suffix(options)}_run_report.json'
+
+
+def shard_block_rows(row_count, shard_count, max_block_rows=1000):
+    # star files with fewer than shard_count*max_block_rows rows get smaller blocks, down to single rows, so no shard
+    # is left without rows
+    return max(min(max_block_rows, row_count//shard_count), 1)
+
+
+def in_shard(row, shard, block_rows=1000):
+    # rows are dealt out to the shards in blocks; consecutive rows mostly come from the same stack, so every shard
+    # reads runs of slices from few stacks while the shards stay balanced
+    return shard is None or (row//block_rows) % shard[1] == shard[0] - 1
+
+
+def table_columns(options):
+    # the optional columns kept in the particle table; a cached table is reused as long as it holds all of them
+    shift_columns = ['rlnOriginXAngst', 'rlnOriginYAngst', 'rlnOriginX', 'rlnOriginY'] if options.apply_shifts == 1 else []
+    half_set_columns = ['rlnRandomSubset'] if options.half_sets == 1 else []
+    return (['rlnClassNumber', 'rlnOpticsGroup'] + shift_columns + half_set_columns
+            + ([options.group_by] if options.group_by is not None else []))
+
+
+def stack_path(stack_name, star_file_name, particle_stack_dir=None):
+    # stack_name is the path after the @ in rlnImageName
+    if particle_stack_dir is not None:
+        return os.path.join(particle_stack_dir, os.path.basename(stack_name))
+    if os.path.isabs(stack_name) or os.path.exists(stack_name):
+        return stack_name
+    return os.path.join(os.path.dirname(os.path.realpath(star_file_name)), stack_name)
+
+
+def find_stack(stack_files, stack_name, star_file_name, particle_stack_dir=None):
+    # every stack the star file references is looked up once, so the particle directory is never listed;
+    # missing stacks are remembered as None and their particles skipped
+    if stack_name not in stack_files:
+        mrcs = stack_path(stack_name, star_file_name, particle_stack_dir)
+        if not os.path.isfile(mrcs):
+            print(f'Warning: particle stack {mrcs} not found, skipping its particles')
+            mrcs = None
+        stack_files[stack_name] = mrcs
+    return stack_files[stack_name]
+
+
+def star_rows_to_columns(rows_text, labels, columns, star_file_name, block_name):
+    # all rows are split into one flat token list in a single call and each column is a strided slice of it
+    tokens = rows_text.split()
+    if len(tokens) % len(labels) != 0:
+        raise AveragingError(f'Could not read {block_name} in {star_file_name}: expected {len(labels)} fields in every row')
+    return {label: tokens[i::len(labels)] for i, label in enumerate(labels) if label in columns}
+
+
+def iter_star_loops(star_file_name, columns, block_bytes=1 << 24):
+    # yields (data block name, {label: list of strings}) for every loop_, at most block_bytes of rows at a time;
+    # the rows of a loop are read in bulk, up to the next blank, comment, label, data_ or loop_ line
+    loop_end = re.compile(r'\n[ \t]*(?:\n|[_#]|data_|loop_)')
+    block_name = ''
+    labels = []
+    with open(star_file_name) as f:
+        buffer = f.read(block_bytes)
+        eof = len(buffer) < block_bytes
+        pos = 0
+        while True:
+            newline = buffer.find('\n', pos)
+            if newline < 0 and not eof:
+                more = f.read(block_bytes)
+                eof = len(more) < block_bytes
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            line = buffer[pos:newline] if newline >= 0 else buffer[pos:]
+            if newline < 0 and not line:
+                return
+            stripped = line.strip()
+            if stripped and stripped[0] not in '_#' and not stripped.startswith(('data_', 'loop_')):
+                while True:
+                    # searching from the newline before pos also catches a terminating line right at pos after a refill
+                    match = loop_end.search(buffer, max(pos - 1, 0))
+                    if match is not None:
+                        end, loop_done = match.start() + 1, True
+                    elif eof:
+                        end, loop_done = len(buffer), True
+                    else:
+                        end, loop_done = buffer.rfind('\n', pos) + 1, False
+                    if end > pos:
+                        yield block_name, star_rows_to_columns(buffer[pos:end], labels, columns, star_file_name, block_name)
+                    pos = end
+                    if loop_done:
+                        break
+                    more = f.read(block_bytes)
+                    eof = len(more) < block_bytes
+                    keep = max(pos - 1, 0)
+                    buffer = buffer[keep:] + more
+                    pos -= keep
+                continue
+            if stripped.startswith('data_'):
+                block_name = stripped
+                labels = []
+            elif stripped.startswith('loop_'):
+                labels = []
+            elif stripped.startswith('_'):
+                labels.append(stripped.split()[0][1:])
+            pos = newline + 1 if newline >= 0 else len(buffer)
+
+
+def star_columns_to_table(star_columns, columns):
+    # image names look like 000012@Extract/job010/Micrographs/mic1.mrcs
+    image_names = np.char.partition(np.array(star_columns['rlnImageName']), '@')
+    stack_names, stack_index = np.unique(image_names[:, 2], return_inverse=True)
+    table = {'stack_names': stack_names, 'stack': stack_index.astype(np.int32),
+             'slice': image_names[:, 0].astype(np.int32) - 1,
+             'psi': np.array(star_columns['rlnAnglePsi'], dtype=np.float64)}
+    for column in columns:
+        if column in star_columns:
+            table[f'column_{column}'] = np.array(star_columns[column])
+    return table
+
+
+def concatenate_tables(tables):
+    stack_names = np.unique(np.concatenate([table['stack_names'] for table in tables]))
+    table = {'stack_names': stack_names}
+    table['stack'] = np.concatenate([np.searchsorted(stack_names, t['stack_names'])[t['stack']] for t in tables]).astype(np.int32)
+    for key in tables[0]:
+        if key not in table:
+            table[key] = np.concatenate([t[key] for t in tables])
+    return table
+
+
+def iter_star_tables(star_file_name, columns, star_info, required_columns=(), block_bytes=1 << 24):
+    # yields the particles of the star file as tables of NumPy columns, a block of rows at a time;
+    # the pixel size of the first optics group goes into star_info
+    if 'rlnAnglePsi' not in columns:
+        columns = ['rlnAnglePsi'] + columns
+    for block_name, star_columns in iter_star_loops(star_file_name, ['rlnImageName', 'rlnImagePixelSize'] + columns, block_bytes):
+        if block_name == 'data_optics' and 'rlnImagePixelSize' in star_columns and 'ang_pix' not in star_info:
+            star_info['ang_pix'] = float(star_columns['rlnImagePixelSize'][0])
+        elif 'rlnImageName' in star_columns:
+            for column in ['rlnAnglePsi'] + list(required_columns):
+                if column not in star_columns:
+                    raise AveragingError(f'No _{column} column in {star_file_name}')
+            yield star_columns_to_table(star_columns, columns)
+
+
+def count_star_rows(star_file_name, block_bytes=1 << 24):
+    # the number of particle rows, reading only the image names
+    return sum(len(star_columns['rlnImageName'])
+               for _, star_columns in iter_star_loops(star_file_name, ['rlnImageName'], block_bytes)
+               if 'rlnImageName' in star_columns)
+
+
+def star_block_bytes(max_mem):
+    # the split rows of a block of star file text take ~25 times its size as Python strings, so the blocks read in
+    # streaming mode are sized to keep that well below max_mem
+    return min(max(max_mem//128, 1 << 18), 1 << 24)
+
+
+def load_star_table(star_file_name, columns):
+    # the parsed table is cached next to the star file, so reruns with other options do not parse it again.
+    # The table can be passed to average_particles for any number of runs with different options
+    cache_file = star_file_name + '.index.npz'
+    star_stat = os.stat(star_file_name)
+    signature = np.array([star_stat.st_size, star_stat.st_mtime_ns])
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as f:
+            if np.array_equal(f['signature'], signature) and set(columns) <= set(f['columns_read']):
+                print(f'Read particle table from {cache_file}')
+                return {key: f[key] for key in f.files}
+
+    star_info = {}
+    tables = list(iter_star_tables(star_file_name, columns, star_info))
+    if not tables:
+        raise AveragingError(f'No particles found in {star_file_name}')
+    table = concatenate_tables(tables)
+    table['ang_pix'] = np.array(star_info.get('ang_pix', 1))
+    table['signature'] = signature
+    table['columns_read'] = np.array(columns, dtype=str)
+    try:
+        with open(cache_file, 'wb') as f:
+            np.savez(f, **table)
+    except OSError:
+        print(f'Could not write the particle table cache {cache_file}')
+    return table
+
+
+def origin_shifts(table, ang_pix=None):
+    # (y, x) shifts in pixels that bring the particles to the box centre, from rlnOriginX/YAngst (RELION 3.1, in Angstrom)
+    # or the rlnOriginX/Y of older star files (in pixels). Zero without either pair of columns, or with ang_pix None
+    if ang_pix is not None:
+        for suffix, scale in [('Angst', ang_pix), ('', 1)]:
+            if f'column_rlnOriginX{suffix}' in table and f'column_rlnOriginY{suffix}' in table:
+                return np.stack([table[f'column_rlnOriginY{suffix}'].astype(np.float64),
+                                 table[f'column_rlnOriginX{suffix}'].astype(np.float64)], axis=1)/scale
+    return np.zeros((len(table['slice']), 2))
+
+
+def splitmix64(values):
+    # the splitmix64 mixing function on a uint64 array, a cheap and well spread hash of star file row numbers
+    with np.errstate(over='ignore'):
+        z = np.asarray(values, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def table_half_sets(table, first_row=0):
+    # 1 or 2 for every particle of a table: its rlnRandomSubset, or for particles without one a hash of the star file row
+    rows = np.arange(first_row, first_row + len(table['slice']), dtype=np.uint64)
+    half_sets = (splitmix64(rows) & np.uint64(1)).astype(np.int64) + 1
+    if 'column_rlnRandomSubset' in table:
+        subsets = table['column_rlnRandomSubset'].astype(np.float64).astype(np.int64)
+        half_sets = np.where(np.isin(subsets, [1, 2]), subsets, half_sets)
+    return half_sets
+
+
+# cumulative Poisson(1) probabilities of 0 to 19, to draw the bootstrap weights by inversion
+poisson_cdf = np.cumsum([math.exp(-1)/math.factorial(k) for k in range(20)])
+
+
+def replicate_count(half_sets, bootstrap):
+    return 2*half_sets + bootstrap
+
+
+def replicate_weights(rows, half_set=None, half_sets=0, bootstrap=0, bootstrap_seed=0):
+    # (replicates, particles) weights: two 0/1 rows for the half sets, then one row of Poisson(1) weights per bootstrap
+    # replicate, hashed from the seed and star file row so they do not depend on the chunking
+    rows = np.asarray(rows, dtype=np.uint64)
+    weights = []
+    if half_sets == 1:
+        weights += [np.full(len(rows), half_set == 1), np.full(len(rows), half_set == 2)]
+    if bootstrap > 0:
+        keys = splitmix64(rows ^ splitmix64(np.array([bootstrap_seed], dtype=np.uint64)))
+        with np.errstate(over='ignore'):
+            hashes = splitmix64(keys[np.newaxis, :] + np.arange(bootstrap, dtype=np.uint64)[:, np.newaxis])
+        weights += list(np.searchsorted(poisson_cdf, (hashes >> np.uint64(11))*2.0**-53, side='right'))
+    return np.array(weights, dtype=np.float32).reshape(-1, len(rows))
+
+
+def table_particles(table, rotate, group_by=None, first_row=0, ang_pix=None, half_sets=0):
+    # yields (row, stack name, slice number, rotation angle, shift, group) for every particle of a table;
+    # shifts are (0, 0) without ang_pix, and with half_sets the group is a (group, half set) pair
+    if group_by is not None and f'column_{group_by}' not in table:
+        raise AveragingError(f'No _{group_by} column in the particle table')
+    stack_names = table['stack_names'].tolist()
+    rotation_angles = -table['psi'] + rotate
+    shifts = map(tuple, origin_shifts(table, ang_pix).tolist())
+    groups = table[f'column_{group_by}'] if group_by is not None else itertools.repeat(None)
+    groups = (str(group) if group is not None else None for group in groups)
+    if half_sets == 1:
+        groups = zip(groups, table_half_sets(table, first_row).tolist())
+    for row, (stack_index, slice_number, rotation_angle, shift, group) in enumerate(
+            zip(table['stack'].tolist(), table['slice'].tolist(), rotation_angles.tolist(), shifts, groups), first_row):
+        yield row, stack_names[stack_index], slice_number, rotation_angle, shift, group
+
+
+def stream_star_particles(star_file_name, columns, star_info, rotate, group_by=None, apply_shifts=0, half_sets=0,
+                          block_bytes=1 << 24):
+    first_row = 0
+    required_columns = [group_by] if group_by is not None else []
+    for table in iter_star_tables(star_file_name, columns, star_info, required_columns, block_bytes):
+        # the optics block with the pixel size comes before the particles
+        ang_pix = star_info.get('ang_pix', 1) if apply_shifts == 1 else None
+        yield from table_particles(table, rotate, group_by, first_row, ang_pix, half_sets)
+        first_row += len(table['slice'])
+
+
+def init_worker(options):
+    global worker_options, worker_result_block, worker_result_slots
+    worker_options = options
+    if 'result_slots' in options:
+        worker_result_block, worker_result_slots = attach_result_slots(*options['result_slots'])
+
+
+def attach_result_slots(shared_memory_name, n_slots, fft_shape, rotated_shape, dtype, variance=0, replicates=0):
+    # returns the shared memory block and a GroupSums of (n_slots, ...) arrays, None for the sums that are not computed
+    block = shared_memory.SharedMemory(name=shared_memory_name)
+    offset = 0
+    # the squared sums are float64 whatever dtype is, and come first so they stay aligned
+    square_slots = None
+    if variance == 1:
+        square_slots = np.ndarray((n_slots,) + fft_shape, dtype=np.float64, buffer=block.buf)
+        offset += square_slots.nbytes
+    fft_slots = np.ndarray((n_slots,) + fft_shape, dtype=dtype, buffer=block.buf, offset=offset)
+    offset += fft_slots.nbytes
+    rotated_slots = None
+    if rotated_shape is not None:
+        rotated_slots = np.ndarray((n_slots,) + rotated_shape, dtype=dtype, buffer=block.buf, offset=offset)
+        offset += rotated_slots.nbytes
+    replicate_slots = None
+    if replicates > 0:
+        replicate_slots = np.ndarray((n_slots, replicates) + fft_shape, dtype=dtype, buffer=block.buf, offset=offset)
+    return block, GroupSums(fft_slots, rotated_slots, square_slots, replicate_slots)
+
+
+def rotate_power_spectrum(fft_amp, rotation_angle, order=3):
+    # same rotation as ndimage.rotate, but about the DC term of the fftshifted array, which is off the array centre for even box sizes
+    c, s = np.cos(np.deg2rad(rotation_angle)), np.sin(np.deg2rad(rotation_angle))
+    rot_matrix = np.array([[c, s], [-s, c]])
+    center = np.array(fft_amp.shape) // 2
+    return ndimage.affine_transform(fft_amp, rot_matrix, offset=center - rot_matrix @ center, order=order)
+
+
+def half_plane_columns(x_dim):
+    # columns of the fftshifted full plane that hold kx = 0 ... x_dim//2, as stored by rfft2
+    return (x_dim//2 + np.arange(x_dim//2 + 1)) % x_dim
+
+
+def expand_half_plane(fft_half, x_dim):
+    # rebuild the fftshifted full amplitude plane by Friedel mirroring, |F(-ky, -kx)| = |F(ky, kx)| for real images
+    # rows of fft_half are fftshifted, columns run from kx = 0 to x_dim//2
+    y_dim = fft_half.shape[0]
+    kx = np.arange(x_dim) - x_dim//2
+    mirrored_rows = (2*(y_dim//2) - np.arange(y_dim)) % y_dim
+    return np.where(kx >= 0, fft_half[:, np.abs(kx)], fft_half[mirrored_rows][:, np.abs(kx)])
+
+
+def add_stage_time(stage_times, stage, start_time):
+    # adds the time since start_time to a stage and returns the current time, so consecutive stages can be chained
+    now = time.perf_counter()
+    if stage_times is not None:
+        stage_times[stage] = stage_times.get(stage, 0) + now - start_time
+    return now
+
+
+# rotation_grid results for every padded box and image box seen by this process
+rotation_grids = {}
+
+
+def rotation_grid(padded_shape, image_box):
+    # flat indices and (y, x) offsets from the centre of the pixels that a rotation of image_box (y0, y1, x0, x1) can reach
+    key = (padded_shape, image_box)
+    if key not in rotation_grids:
+        center_y, center_x = (padded_shape[0] - 1)/2, (padded_shape[1] - 1)/2
+        y0, y1, x0, x1 = image_box
+        radius = max(np.hypot(y - center_y, x - center_x) for y in [y0 - 0.5, y1 - 0.5] for x in [x0 - 0.5, x1 - 0.5]) + 1
+        offset_y, offset_x = np.indices(padded_shape, dtype=np.float64)
+        offset_y -= center_y
+        offset_x -= center_x
+        pixels = np.flatnonzero(offset_y**2 + offset_x**2 <= radius**2)
+        rotation_grids[key] = (pixels, offset_y.ravel()[pixels], offset_x.ravel()[pixels])
+    return rotation_grids[key]
+
+
+def rotate_batch(img_batch, rotation_angles, rotated_batch, pad_y, pad_x, order=3):
+    # writes the (N, y, x) batch, each image rotated by its angle, into rotated_batch (N, padded y, padded x) at the pad
+    # offsets; the same as ndimage.rotate of each zero-padded image, in one map_coordinates call
+    n_images, y_dim, x_dim = img_batch.shape
+    padded_shape = rotated_batch.shape[1:]
+    margin = 4*order + 1 if order > 1 else 1
+    y0, x0 = max(pad_y - margin, 0), max(pad_x - margin, 0)
+    y1, x1 = min(pad_y + y_dim + margin, padded_shape[0]), min(pad_x + x_dim + margin, padded_shape[1])
+    pixels, offset_y, offset_x = rotation_grid(padded_shape, (y0, y1, x0, x1))
+    if order == 0 or len(pixels) > 0.6*rotated_batch[0].size:
+        # with little or no padding there is not much to leave out, and ndimage.rotate, which steps through the output
+        # grid instead of reading coordinate arrays, is quicker. Nearest-neighbour sampling often falls exactly halfway
+        # between pixels (e.g. at 120 degrees), where only ndimage.rotate's own coordinates round the same way
+        rotated_batch[:, pad_y:pad_y+y_dim, pad_x:pad_x+x_dim] = img_batch
+        for n, rotation_angle in enumerate(rotation_angles):
+            rotated_batch[n] = ndimage.rotate(rotated_batch[n], rotation_angle, reshape=False, order=order)
+        return
+    # the spline prefilter only needs a margin of zeros around the images, past which its tail is below float32 precision
+    box = np.zeros((n_images, y1 - y0, x1 - x0), dtype=np.float32)
+    box[:, pad_y-y0:pad_y-y0+y_dim, pad_x-x0:pad_x-x0+x_dim] = img_batch
+    if order > 1:
+        for axis in [1, 2]:
+            box = ndimage.spline_filter1d(box, order, axis=axis, mode='mirror', output=np.float32)
+    # every image gets a mirrored border, as ndimage extends a single image, so its spline never reaches into the next
+    border = order + 1
+    mosaic = np.pad(box, ((0, 0), (border, border), (border, border)), mode='reflect')
+    angles = np.deg2rad(np.asarray(rotation_angles, dtype=np.float64))[:, np.newaxis]
+    c, s = np.cos(angles), np.sin(angles)
+    source_y = c*offset_y + s*offset_x + ((padded_shape[0] - 1)/2 - y0)
+    source_x = c*offset_x - s*offset_y + ((padded_shape[1] - 1)/2 - x0)
+    # like ndimage with mode 'constant', nothing is interpolated outside the input
+    outside = (source_y < 0) | (source_y > y1 - y0 - 1) | (source_x < 0) | (source_x > x1 - x0 - 1)
+    source_y += (np.arange(n_images)*mosaic.shape[1] + border)[:, np.newaxis]
+    source_x += border
+    values = ndimage.map_coordinates(mosaic.reshape(-1, mosaic.shape[2]), [source_y, source_x], order=order, prefilter=False,
+                                     output=np.float32)
+    values[outside] = 0
+    rotated_batch.reshape(n_images, -1)[:, pixels] = values
+
+
+def rotate_shifts(shifts, rotation_angles):
+    # the (y, x) shifts of particles after ndimage.rotate by rotation_angles: shifting and then rotating an image is the
+    # same as rotating it and then shifting it by the rotated shift
+    c, s = np.cos(np.deg2rad(rotation_angles)), np.sin(np.deg2rad(rotation_angles))
+    return np.stack([c*shifts[:, 0] - s*shifts[:, 1], s*shifts[:, 0] + c*shifts[:, 1]], axis=1)
+
+
+def shifted_sum(fft_half, shifts, shape, sum_dtype=np.float64):
+    # the real-space sum of images shifted by (y, x) shifts in pixels, from their rfft2 halves: each is multiplied by
+    # its phase ramp, which is separable in y and x, and only the sum is transformed back. fft_half is overwritten
+    ramp_y = np.exp(-2j*np.pi*shifts[:, 0, np.newaxis]*scipy.fft.fftfreq(shape[0])).astype(fft_half.dtype)
+    ramp_x = np.exp(-2j*np.pi*shifts[:, 1, np.newaxis]*scipy.fft.rfftfreq(shape[1])).astype(fft_half.dtype)
+    fft_half *= ramp_y[:, :, np.newaxis]
+    fft_half *= ramp_x[:, np.newaxis, :]
+    return scipy.fft.irfft2(fft_half.sum(axis=0, dtype=np.result_type(sum_dtype, np.complex64)), s=shape)
+
+
+def process_batch(img_batch, rotation_angles, pad_x, pad_y, half_plane, fft_workers=1, sum_dtype=np.float64, realspace=1,
+                  stage_times=None, shifts=None, interp_order=3, variance=0, weights=None):
+    # pads, rotates and transforms an (N, y, x) batch in one multi-axis FFT call; returns the amplitude, real-space,
+    # float64 squared amplitude and replicate amplitude sums, None for the ones not asked for
+    start_time = time.perf_counter()
+    n_images, y_dim, x_dim = img_batch.shape
+    img_batch_rotated = np.zeros((n_images, y_dim + 2*pad_y, x_dim + 2*pad_x), dtype=np.float32)
+    if rotation_angles is not None:
+        start_time = add_stage_time(stage_times, 'pad', start_time)
+        rotate_batch(img_batch, rotation_angles, img_batch_rotated, pad_y, pad_x, interp_order)
+        start_time = add_stage_time(stage_times, 'rotate', start_time)
+    else:
+        img_batch_rotated[:, pad_y:pad_y+y_dim, pad_x:pad_x+x_dim] = img_batch
+        start_time = add_stage_time(stage_times, 'pad', start_time)
+    if half_plane == 1:
+        fft_batch = scipy.fft.rfft2(img_batch_rotated, axes=(-2, -1), workers=fft_workers)
+        fft_batch_amp = np.abs(fft_batch)
+        start_time = add_stage_time(stage_times, 'fft', start_time)
+        shift_axes = (-2,)
+    else:
+        fft_batch = scipy.fft.fft2(img_batch_rotated, axes=(-2, -1), workers=fft_workers)
+        fft_batch_amp = np.abs(fft_batch)
+        start_time = add_stage_time(stage_times, 'fft', start_time)
+        shift_axes = (-2, -1)
+    fft_sum = np.fft.fftshift(fft_batch_amp.sum(axis=0, dtype=sum_dtype), axes=shift_axes)
+    fft_replicate_sum = None
+    if weights is not None:
+        fft_replicate_sum = np.fft.fftshift(np.tensordot(weights, fft_batch_amp, axes=1).astype(sum_dtype), axes=shift_axes)
+    fft_square_sum = None
+    if variance == 1:
+        fft_square_sum = np.fft.fftshift(np.square(fft_batch_amp, out=fft_batch_amp).sum(axis=0, dtype=np.float64), axes=shift_axes)
+    rotated_sum = None if realspace == 0 else img_batch_rotated.sum(axis=0, dtype=sum_dtype)
+    start_time = add_stage_time(stage_times, 'sum', start_time)
+    if realspace == 1 and shifts is not None and np.any(shifts):
+        # the amplitudes do not change with a shift, so the origin shifts are only applied to the real-space sum
+        shifts = np.array(shifts, dtype=np.float64)
+        if rotation_angles is not None:
+            shifts = rotate_shifts(shifts, np.array(rotation_angles))
+        # the first x_dim//2 + 1 columns of the full FFT are the rfft2 half
+        image_shape = img_batch_rotated.shape[1:]
+        rotated_sum = shifted_sum(fft_batch[:, :, :image_shape[1]//2 + 1], shifts, image_shape, sum_dtype).astype(sum_dtype)
+        add_stage_time(stage_times, 'shift', start_time)
+    return fft_sum, rotated_sum, fft_square_sum, fft_replicate_sum
+
+
+def read_slices(f, data_offset, slice_shape, dtype, slice_numbers):
+    # slice_numbers are in ascending order; every run of consecutive slices is read with one seek and one read
+    slice_bytes = slice_shape[0]*slice_shape[1]*dtype.itemsize
+    img_batch = np.empty((len(slice_numbers),) + slice_shape, dtype=dtype)
+    batch_bytes = memoryview(img_batch).cast('B')
+    run_start = 0
+    for i in range(1, len(slice_numbers) + 1):
+        if i < len(slice_numbers) and slice_numbers[i] == slice_numbers[i-1] + 1:
+            continue
+        f.seek(data_offset + slice_numbers[run_start]*slice_bytes)
+        position = run_start*slice_bytes
+        while position < i*slice_bytes:
+            n_bytes = f.readinto(batch_bytes[position:i*slice_bytes])
+            if not n_bytes:
+                raise OSError(f'{f.name} ends before slice {slice_numbers[i-1] + 1}')
+            position += n_bytes
+        run_start = i
+    return img_batch
+
+
+def read_batches(stack_particles, batch_size):
+    # yields (image batch, rotation angles, shifts, star file rows) for every batch of a chunk. Only the header is parsed by mrcfile;
+    # the slices are read straight from the file, in the ascending slice order the chunks are built in
+    for mrcs, particles_selected in stack_particles:
+        with mrcfile.open(mrcs, permissive=True, header_only=True) as f:
+            header = f.header
+        data_offset = header.nbytes + int(header.nsymbt)
+        slice_shape = (int(header.ny), int(header.nx))
+        dtype = mrcfile.utils.data_dtype_from_header(header)
+        with open(mrcs, 'rb', buffering=0) as f:
+            for i in range(0, len(particles_selected), batch_size):
+                slice_numbers, rotation_angles, shifts, rows = zip(*particles_selected[i:i+batch_size])
+                yield read_slices(f, data_offset, slice_shape, dtype, slice_numbers), rotation_angles, shifts, rows
+
+
+def read_ahead(batches, depth):
+    # runs the batches generator on a background thread that stays up to depth batches ahead of the consumer.
+    # NumPy releases the GIL while copying the slices and computing the FFTs, so the reads overlap with the compute
+    if depth <= 0:
+        yield from batches
+        return
+    batch_queue = queue.Queue(maxsize=depth)
+    done = object()
+
+    def reader():
+        try:
+            for batch in batches:
+                batch_queue.put(batch)
+            batch_queue.put(done)
+        except BaseException as e:
+            batch_queue.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    while True:
+        batch = batch_queue.get()
+        if batch is done:
+            break
+        if isinstance(batch, BaseException):
+            raise batch
+        yield batch
+    thread.join()
+
+
+def rotate_amplitude_sum(fft_sum, rotation_angle, half_plane, padded_x_dim, order=3):
+    # a half-plane sum is rotated as the full plane and cut back to its half
+    if half_plane == 1:
+        fft_sum = rotate_power_spectrum(expand_half_plane(fft_sum, padded_x_dim), rotation_angle, order)
+        return fft_sum[:, half_plane_columns(padded_x_dim)]
+    return rotate_power_spectrum(fft_sum, rotation_angle, order)
+
+
+def process_particles(chunk):
+    # reads and sums the particles of one chunk, all of one group (and angle bin); returns the group, their GroupSums,
+    # rows and (stage times, bytes read, worker name)
+    group, bin_angle, stack_particles = chunk
+    pad_factor = worker_options['pad_factor']
+    fast_fft = worker_options['fast_fft']
+    batch_size = worker_options['batch_size']
+    half_plane = worker_options['half_plane']
+    realspace = worker_options['realspace']
+    variance = worker_options['variance']
+    half_sets = worker_options['half_sets']
+    bootstrap = worker_options['bootstrap']
+    half_set = group[1] if half_sets == 1 else None
+    replicates = replicate_count(half_sets, bootstrap)
+    fft_sum = 0
+    rotated_sum = 0 if realspace == 1 else None
+    fft_square_sum = 0 if variance == 1 else None
+    fft_replicate_sum = 0 if replicates > 0 else None
+    processed = []
+    stage_times = {'read': 0}
+    bytes_read = 0
+    batches = read_ahead(read_batches(stack_particles, batch_size), worker_options['read_ahead'])
+    while True:
+        start_time = time.perf_counter()
+        batch = next(batches, None)
+        add_stage_time(stage_times, 'read', start_time)
+        if batch is None:
+            break
+        img_batch, rotation_angles, shifts, rows = batch
+        pad_x = pad_width(img_batch.shape[2], pad_factor, fast_fft)
+        pad_y = pad_width(img_batch.shape[1], pad_factor, fast_fft)
+        if bin_angle is not None:
+            rotation_angles = None
+        padded_x_dim = img_batch.shape[2] + 2*pad_x
+        weights = None
+        if replicates > 0:
+            weights = replicate_weights(rows, half_set, half_sets, bootstrap, worker_options['bootstrap_seed'])
+        fft_batch_sum, rotated_batch_sum, fft_square_batch_sum, fft_replicate_batch_sum = process_batch(
+            img_batch, rotation_angles, pad_x, pad_y, half_plane, worker_options['fft_workers'], worker_options['sum_dtype'],
+            realspace, stage_times, shifts, worker_options['interp_order'], variance, weights)
+        start_time = time.perf_counter()
+        fft_sum += fft_batch_sum
+        if realspace == 1:
+            rotated_sum += rotated_batch_sum
+        if variance == 1:
+            fft_square_sum += fft_square_batch_sum
+        if replicates > 0:
+            fft_replicate_sum += fft_replicate_batch_sum
+        processed.extend(rows)
+        bytes_read += img_batch.nbytes
+        add_stage_time(stage_times, 'sum', start_time)
+    start_time = time.perf_counter()
+    # the particles of an angle bin are summed unrotated and the sums rotated once
+    if bin_angle is not None:
+        if realspace == 1:
+            rotated_sum = ndimage.rotate(rotated_sum, bin_angle, reshape=False, order=worker_options['interp_order'])
+        fft_sum = rotate_amplitude_sum(fft_sum, bin_angle, half_plane, padded_x_dim, worker_options['interp_order'])
+        if variance == 1:
+            fft_square_sum = rotate_amplitude_sum(fft_square_sum, bin_angle, half_plane, padded_x_dim, worker_options['interp_order'])
+        if replicates > 0:
+            fft_replicate_sum = np.array([rotate_amplitude_sum(replicate_sum, bin_angle, half_plane, padded_x_dim,
+                                                               worker_options['interp_order'])
+                                          for replicate_sum in fft_replicate_sum])
+        add_stage_time(stage_times, 'rotate', start_time)
+    worker = multiprocessing.current_process().name
+    if worker == 'MainProcess':
+        worker = threading.current_thread().name
+    chunk_sums = GroupSums(fft_sum, rotated_sum, fft_square_sum, fft_replicate_sum, len(processed))
+    return group, chunk_sums, processed, (stage_times, bytes_read, worker)
+
+
+def process_particles_to_slot(task):
+    # process backend: the partial sums are written into the result slot the parent handed out with the chunk,
+    # so only the slot number, rows and timings go back through the result pipe
+    slot, chunk = task
+    group, chunk_sums, processed, timings = process_particles(chunk)
+    for name, slot_array in worker_result_slots.arrays().items():
+        if slot_array is not None:
+            slot_array[slot] = getattr(chunk_sums, name)
+    return group, slot, processed, timings
+
+
+def interleave_chunks(stack_chunks):
+    # round-robin over the stacks so particles from different files are processed side by side
+    for chunks in itertools.zip_longest(*stack_chunks):
+        for chunk in chunks:
+            if chunk is not None:
+                yield chunk
+
 
-        with multiprocessing.Pool(processes=n_processes) as pool:
-            results = pool.map(process_particle, process_args)
+def split_by_group(particles_selected):
+    group_particles = {}
+    for slice_number, rotation_angle, shift, group, row in particles_selected:
+        group_particles.setdefault(group, []).append((slice_number, rotation_angle, shift, row))
+    return group_particles
 
-        for fft_slice_amp, img_slice_rotated in results:
-            process_count += 1
-            if type(fft_stack) is np.ndarray:
-                fft_stack = fft_stack + fft_slice_amp
-                rotated_stack = rotated_stack + img_slice_rotated
+
+def group_sort_key(group):
+    # numeric groups such as class numbers sort by value, anything else alphabetically
+    try:
+        return (0, float(group), group)
+    except ValueError:
+        return (1, 0, group)
+
+
+def split_by_stack(particles):
+    # the particles of each stack are put in slice order, so they are read front to back
+    stack_particles = {}
+    for mrcs, slice_number, rotation_angle, shift, row in particles:
+        stack_particles.setdefault(mrcs, []).append((slice_number, rotation_angle, shift, row))
+    return [(mrcs, sorted(particles_selected)) for mrcs, particles_selected in stack_particles.items()]
+
+
+def print_angle_bin_histogram(bin_counts, bin_width):
+    occupancy = np.array(list(bin_counts.values()))
+    print(f'{len(bin_counts)} angle bins of {bin_width} degrees occupied, '
+          f'particles per bin: min {occupancy.min()}, median {np.median(occupancy):.0f}, max {occupancy.max()}')
+    # summarise the occupancy in 10 degree rows so the histogram stays readable for fine bins
+    row_counts = {}
+    for bin_index, bin_count in bin_counts.items():
+        row = int(np.floor(bin_index*bin_width/10))*10
+        row_counts[row] = row_counts.get(row, 0) + bin_count
+    bar_scale = 50/max(row_counts.values())
+    for row in sorted(row_counts):
+        print(f'{row:5d} to {row+10:4d} deg: {row_counts[row]:8d} {"#"*int(np.ceil(row_counts[row]*bar_scale))}')
+
+
+def angle_bin_index(rotation_angle, angle_bin):
+    return int(np.round(((rotation_angle + 180) % 360 - 180)/angle_bin))
+
+
+def add_processed_rows(processed_rows, rows):
+    # processed_rows is a bool mask over the star file rows, as chunks finish in no particular row order;
+    # it doubles when a streamed row is past its end, so the mask is returned
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) > 0 and rows.max() >= len(processed_rows):
+        grown_rows = np.zeros(max(2*len(processed_rows), rows.max() + 1), dtype=bool)
+        grown_rows[:len(processed_rows)] = processed_rows
+        processed_rows = grown_rows
+    processed_rows[rows] = True
+    return processed_rows
+
+
+def is_processed(processed_rows, row):
+    return row < len(processed_rows) and bool(processed_rows[row])
+
+
+def add_compensated(total, compensation, value):
+    # one step of Kahan summation, in place; compensation carries the low-order bits lost from total so far
+    corrected = value - compensation
+    new_total = total + corrected
+    compensation[...] = (new_total - total) - corrected
+    total[...] = new_total
+
+
+class GroupSums:
+    # the sums of one group or chunk, with its particle count and the summed weights of the half set and bootstrap
+    # replicates; sums that are not computed are None
+    array_names = ('fft_sum', 'rotated_sum', 'square_sum', 'replicate_sum')
+
+    def __init__(self, fft_sum=None, rotated_sum=None, square_sum=None, replicate_sum=None, count=0, replicate_weights=None):
+        self.fft_sum = fft_sum
+        self.rotated_sum = rotated_sum
+        self.square_sum = square_sum
+        self.replicate_sum = replicate_sum
+        self.count = count
+        self.replicate_weights = replicate_weights
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.array_names}
+
+    def slot(self, slot, count):
+        # the sums of the count particles of one chunk, when the arrays hold one set of sums per shared memory slot
+        return GroupSums(*[None if array is None else array[slot] for array in self.arrays().values()], count)
+
+    def add(self, other):
+        for name, array in other.arrays().items():
+            if array is not None:
+                setattr(self, name, getattr(self, name) + array)
+        self.count += other.count
+        if other.replicate_weights is not None:
+            self.replicate_weights = self.replicate_weights + other.replicate_weights
+
+
+class PowerSpectrumAccumulator:
+    # one GroupSums per group (only None without group_by), and the star file rows in them for resuming
+    def __init__(self, dtype=np.float64, compensated=False):
+        self.sums = {}
+        self.processed_rows = np.zeros(0, dtype=bool)
+        self.padded_x_dim = None
+        self.dtype = dtype
+        self.compensated = compensated
+        self.compensation = {}
+
+    def add(self, group, partial_sums, rows):
+        # partial_sums is the GroupSums of the particles of the star file rows
+        if group not in self.sums:
+            # the squared amplitudes are always summed in double precision
+            self.sums[group] = GroupSums(**{name: None if array is None else
+                                            np.zeros_like(array, dtype=np.float64 if name == 'square_sum' else self.dtype)
+                                            for name, array in partial_sums.arrays().items()})
+            if partial_sums.replicate_weights is not None:
+                self.sums[group].replicate_weights = np.zeros_like(partial_sums.replicate_weights)
+        group_sums = self.sums[group]
+        if self.compensated and group not in self.compensation:
+            # sums read from a checkpoint start again with no compensation
+            self.compensation[group] = {name: None if total is None else np.zeros_like(total)
+                                        for name, total in group_sums.arrays().items()}
+        for name, partial_sum in partial_sums.arrays().items():
+            if partial_sum is None:
+                continue
+            if self.compensated:
+                add_compensated(getattr(group_sums, name), self.compensation[group][name], partial_sum)
             else:
-                fft_stack = fft_slice_amp
-                rotated_stack = img_slice_rotated
-            print(f'Processed {process_count} out of {total_particle_count} particles in the star file')
+                getattr(group_sums, name)[...] += partial_sum
+        group_sums.count += partial_sums.count
+        if partial_sums.replicate_weights is not None:
+            group_sums.replicate_weights += partial_sums.replicate_weights
+        self.processed_rows = add_processed_rows(self.processed_rows, rows)
+
+    def process_count(self):
+        return sum(group_sums.count for group_sums in self.sums.values())
+
+    def groups(self):
+        return sorted(self.sums, key=lambda group: group_sort_key(group or ''))
+
+    def average(self, group, half_plane=0):
+        # the average amplitude spectrum (full plane, fftshifted, not oversampled) and real-space image of a group
+        group_sums = self.sums[group]
+        fft_average = group_sums.fft_sum/group_sums.count
+        if half_plane == 1:
+            fft_average = expand_half_plane(fft_average, self.padded_x_dim)
+        return fft_average, (None if group_sums.rotated_sum is None else group_sums.rotated_sum/group_sums.count)
+
+    def standard_deviation(self, group, half_plane=0):
+        # the standard deviation of the particle amplitudes at every Fourier pixel of a group, from the amplitude and
+        # squared amplitude sums; None without squared sums
+        group_sums = self.sums[group]
+        if group_sums.square_sum is None:
+            return None
+        # rounding can make the difference of the sums slightly negative where the amplitudes hardly vary
+        count = group_sums.count
+        variance = np.maximum(group_sums.square_sum - group_sums.fft_sum.astype(np.float64)**2/count, 0)/max(count - 1, 1)
+        fft_std = np.sqrt(variance)
+        if half_plane == 1:
+            fft_std = expand_half_plane(fft_std, self.padded_x_dim)
+        return fft_std
+
+    def replicate_averages(self, group, half_plane=0):
+        # the (replicates, y, x) average amplitude spectra of the half sets and bootstrap replicates of a group; None without them
+        group_sums = self.sums[group]
+        if group_sums.replicate_sum is None:
+            return None
+        # an empty half set of a small group averages to zeros
+        fft_replicate_averages = group_sums.replicate_sum/np.maximum(group_sums.replicate_weights, 1)[:, np.newaxis, np.newaxis]
+        if half_plane == 1:
+            fft_replicate_averages = np.array([expand_half_plane(fft_average, self.padded_x_dim)
+                                               for fft_average in fft_replicate_averages])
+        return fft_replicate_averages
+
+
+def sum_dtype(options):
+    return np.float32 if options.precision == 'single' else np.float64
+
+
+def checkpoint_parameters(options):
+    # a checkpoint can only be resumed on the same star file with the options that change what goes into the sums
+    return np.array([options.pad_factor, options.rotate, options.angle_bin, options.half_plane,
+                     options.precision == 'single', options.realspace, os.path.getsize(options.input_star),
+                     options.realspace == 1 and options.apply_shifts == 1, options.interp_order, options.fast_fft,
+                     options.variance, options.half_sets, options.bootstrap, options.bootstrap_seed],
+                    dtype=np.float64)
+
+
+# the options that name and shape the averages, saved by name in partial sums files so merge can write them
+merge_option_names = ['pad_factor', 'half_plane', 'realspace', 'half_sets', 'bootstrap']
+
+
+def write_checkpoint(checkpoint_file, accumulator, options, extra=None):
+    # the partial sums of a shard are written in the same format, with the extra arrays needed to merge them
+    groups = accumulator.groups()
+    checkpoint = {'groups': np.array([group or '' for group in groups], dtype=str), 'group_by': np.array(options.group_by or ''),
+                  'fft_stack': np.array([accumulator.sums[group].fft_sum for group in groups]),
+                  'process_count': np.array([accumulator.sums[group].count for group in groups]),
+                  'padded_x_dim': np.array(accumulator.padded_x_dim or 0),
+                  'parameters': checkpoint_parameters(options),
+                  'processed_rows': np.packbits(accumulator.processed_rows)}
+    if options.realspace == 1:
+        checkpoint['rotated_stack'] = np.array([accumulator.sums[group].rotated_sum for group in groups])
+    if options.variance == 1:
+        checkpoint['fft_square_stack'] = np.array([accumulator.sums[group].square_sum for group in groups])
+    if replicate_count(options.half_sets, options.bootstrap) > 0:
+        checkpoint['fft_replicate_stack'] = np.array([accumulator.sums[group].replicate_sum for group in groups])
+        checkpoint['replicate_weight_sums'] = np.array([accumulator.sums[group].replicate_weights for group in groups])
+    checkpoint.update(extra or {})
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **checkpoint)
+    # replace the old checkpoint only once the new one is complete, so a crash while writing never loses it
+    os.replace(tmp_file, checkpoint_file)
+
+
+def load_sums(sums_file, dtype=np.float64, compensated=False):
+    # reads a checkpoint or partial sums file into an accumulator; returns it with the rest of the file's arrays
+    accumulator = PowerSpectrumAccumulator(dtype, compensated)
+    with np.load(sums_file) as f:
+        group_by = str(f['group_by']) or None
+        rotated_stack = f['rotated_stack'] if 'rotated_stack' in f.files else itertools.repeat(None)
+        fft_square_stack = f['fft_square_stack'] if 'fft_square_stack' in f.files else itertools.repeat(None)
+        fft_replicate_stack = f['fft_replicate_stack'] if 'fft_replicate_stack' in f.files else itertools.repeat(None)
+        replicate_weight_sums = f['replicate_weight_sums'] if 'replicate_weight_sums' in f.files else itertools.repeat(None)
+        accumulator.sums = {
+            (str(group) if group_by is not None else None): GroupSums(fft_sum, rotated_sum, fft_square_sum, fft_replicate_sum,
+                                                                      int(count), weight_sums)
+            for group, fft_sum, rotated_sum, fft_square_sum, fft_replicate_sum, count, weight_sums in zip(
+                f['groups'], f['fft_stack'], rotated_stack, fft_square_stack, fft_replicate_stack, f['process_count'],
+                replicate_weight_sums)
+        }
+        # 0 for a shard that had no particles
+        accumulator.padded_x_dim = int(f['padded_x_dim']) or None
+        accumulator.processed_rows = np.unpackbits(f['processed_rows']).astype(bool)
+        metadata = {name: f[name] for name in f.files
+                    if name not in ['groups', 'fft_stack', 'rotated_stack', 'fft_square_stack', 'fft_replicate_stack',
+                                    'process_count', 'replicate_weight_sums']}
+    metadata['group_by'] = group_by
+    return accumulator, metadata
+
+
+def read_checkpoint(checkpoint_file, options):
+    accumulator, metadata = load_sums(checkpoint_file, sum_dtype(options), options.compensated == 1)
+    if not np.array_equal(metadata['parameters'], checkpoint_parameters(options)) or metadata['group_by'] != options.group_by:
+        raise AveragingError(f'{checkpoint_file} was written for a different star file or with different pad, rotate, '
+                             f'angle_bin, half_plane, precision, realspace, apply_shifts, interp_order, fast_fft, variance, half_sets, '
+                             f'bootstrap or group_by options')
+    return accumulator
+
+
+def write_partial_sums(accumulator, ang_pix, options):
+    # what a shard writes instead of the averages: its sums, the shard, and what merge needs to name and write the averages
+    partial_sums_file = partial_sums_file_name(options)
+    extra = {'shard': np.array(options.shard), 'ang_pix': np.array(ang_pix), 'input_star': np.array(options.input_star)}
+    extra.update({f'option_{name}': np.array(getattr(options, name)) for name in merge_option_names})
+    write_checkpoint(partial_sums_file, accumulator, options, extra)
+    print(f'\nSaved the partial sums of {accumulator.process_count()} particles of shard {options.shard[0]}/{options.shard[1]} '
+          f'to {partial_sums_file}')
+    return partial_sums_file
+
+
+def merge_processed_rows(processed_rows, other_rows):
+    # the union of two processed row masks; shards never share a row, so an overlap means a partial sums file was
+    # given twice or comes from another sharding
+    merged = np.zeros(max(len(processed_rows), len(other_rows)), dtype=bool)
+    merged[:len(processed_rows)] = processed_rows
+    shared_rows = np.flatnonzero(merged[:len(other_rows)] & other_rows)
+    if len(shared_rows) > 0:
+        raise AveragingError(f'{len(shared_rows)} star file rows, the first is row {shared_rows[0]}, are in more than one '
+                             f'partial sums file')
+    merged[:len(other_rows)] |= other_rows
+    return merged
+
+
+def merge_partial_sums(partial_sums_files):
+    # adds up the partial sums files of the shards of a star file; returns the accumulator, the pixel size and the
+    # metadata of the first file (parameters, group_by, input_star) for writing the averages
+    accumulator, metadata = load_sums(partial_sums_files[0])
+    if 'shard' not in metadata:
+        raise AveragingError(f'{partial_sums_files[0]} is not a partial sums file of a shard')
+    shards = [int(metadata['shard'][0])]
+    for partial_sums_file in partial_sums_files[1:]:
+        partial, partial_metadata = load_sums(partial_sums_file)
+        if ('shard' not in partial_metadata or not np.array_equal(partial_metadata['parameters'], metadata['parameters'])
+                or partial_metadata['group_by'] != metadata['group_by'] or partial_metadata['shard'][1] != metadata['shard'][1]
+                or (None not in [partial.padded_x_dim, accumulator.padded_x_dim] and partial.padded_x_dim != accumulator.padded_x_dim)):
+            raise AveragingError(f'{partial_sums_file} and {partial_sums_files[0]} are not shards of the same star file '
+                                 f'with the same options')
+        accumulator.processed_rows = merge_processed_rows(accumulator.processed_rows, partial.processed_rows)
+        accumulator.padded_x_dim = accumulator.padded_x_dim or partial.padded_x_dim
+        for group, partial_group_sums in partial.sums.items():
+            if group not in accumulator.sums:
+                accumulator.sums[group] = partial_group_sums
+                continue
+            accumulator.sums[group].add(partial_group_sums)
+        shards.append(int(partial_metadata['shard'][0]))
+    if not accumulator.sums:
+        raise AveragingError('The partial sums files have no particles')
+    shard_count = int(metadata['shard'][1])
+    missing_shards = sorted(set(range(1, shard_count + 1)) - set(shards))
+    if missing_shards:
+        print(f'Warning: shards {", ".join(str(shard) for shard in missing_shards)} of {shard_count} are missing; '
+              f'the averages only include the other shards')
+    return accumulator, float(metadata['ang_pix']), metadata
+
+
+def pad_width(dim, pad_factor, fast_fft=0):
+    # zeros added on each side of a dimension of dim pixels. With fast_fft the padded length is the next length
+    # scipy.fft transforms quickly whose difference to dim is even, so the image stays centred in the padded box
+    pad = int(dim*(pad_factor-1)/2)
+    if fast_fft == 1:
+        padded_dim = scipy.fft.next_fast_len(dim + 2*pad)
+        while (padded_dim - dim) % 2 == 1:
+            padded_dim = scipy.fft.next_fast_len(padded_dim + 1)
+        pad = (padded_dim - dim)//2
+    return pad
+
+
+def padded_shape(stack, pad_factor, fast_fft=0):
+    with mrcfile.open(stack, permissive=True, header_only=True) as f:
+        x_dim, y_dim = int(f.header.nx), int(f.header.ny)
+    return y_dim + 2*pad_width(y_dim, pad_factor, fast_fft), x_dim + 2*pad_width(x_dim, pad_factor, fast_fft)
+
+
+def max_chunks_in_flight(first_stack, options):
+    # without a memory ceiling keep every process busy with one chunk queued behind it
+    if options.max_mem is None:
+        return 2*options.processes
+    padded_pixels = np.prod(padded_shape(first_stack, options.pad_factor, options.fast_fft))
+    # a chunk holds a list of particles (~200 bytes each) and its result an amplitude and (optionally) a real-space,
+    # a float64 squared amplitude and the replicate amplitude sums;
+    # a busy process also holds a padded float32 batch, its FFT and amplitudes and the rotation coordinates (~40 bytes per pixel)
+    # on top of its own sums, and up to read_ahead batches that were read ahead.
+    # The block of star file rows being parsed takes ~32 times its text size
+    result_arrays = 1 + options.realspace + replicate_count(options.half_sets, options.bootstrap)
+    result_bytes = (result_arrays*np.dtype(sum_dtype(options)).itemsize + options.variance*8)*padded_pixels + 200*options.chunk_size
+    process_bytes = options.batch_size*(40 + 4*max(options.read_ahead, 0))*padded_pixels + result_bytes
+    free_bytes = options.max_mem - options.processes*process_bytes - 32*star_block_bytes(options.max_mem)
+    if free_bytes < options.processes*result_bytes:
+        print(f'Warning: --max_mem is too small for {options.processes} processes with batches of {options.batch_size} particles')
+        return options.processes
+    return int(free_bytes//result_bytes)
+
+
+def stream_chunks(particles, stack_files, processed_rows, bin_counts, options, block_rows=1000):
+    # chunks are built while the star file is read; only one partly filled chunk per group (and angle bin) is kept
+    pending = {}
+    for row, stack_name, slice_number, rotation_angle, shift, group in particles:
+        if not in_shard(row, options.shard, block_rows):
+            continue
+        mrcs = find_stack(stack_files, stack_name, options.input_star, options.particle_dir)
+        if mrcs is None or is_processed(processed_rows, row):
+            continue
+        bin_index = None
+        if options.angle_bin > 0:
+            bin_index = angle_bin_index(rotation_angle, options.angle_bin)
+            bin_counts[bin_index] = bin_counts.get(bin_index, 0) + 1
+        chunk_particles = pending.setdefault((group, bin_index), [])
+        chunk_particles.append((mrcs, slice_number, rotation_angle, shift, row))
+        if len(chunk_particles) == options.chunk_size:
+            yield (group, None if bin_index is None else bin_index*options.angle_bin,
+                   split_by_stack(pending.pop((group, bin_index))))
+    for (group, bin_index), chunk_particles in pending.items():
+        yield (group, None if bin_index is None else bin_index*options.angle_bin, split_by_stack(chunk_particles))
 
-fft_average = fft_stack/process_count
 
-if args.symmetrize == 1:
-    ydim = fft_average.shape[0] 
+def table_chunks(star_table, stack_files, processed_rows, bin_counts, options):
+    # returns the chunks of all particles of a loaded star table that are not processed yet, and how many particles they hold
+    particle_dic = {}
+    total_particle_count = 0
+    ang_pix = float(star_table['ang_pix']) if options.apply_shifts == 1 else None
+    block_rows = shard_block_rows(len(star_table['slice']), options.shard[1]) if options.shard is not None else None
+    for row, stack_name, slice_number, rotation_angle, shift, group in table_particles(star_table, options.rotate, options.group_by,
+                                                                                       ang_pix=ang_pix, half_sets=options.half_sets):
+        if not in_shard(row, options.shard, block_rows):
+            continue
+        total_particle_count += 1
+        if not is_processed(processed_rows, row):
+            particle_dic.setdefault(stack_name, []).append((slice_number, rotation_angle, shift, group, row))
+
+    stack_particles = []
+    for stack_name, particles_selected in particle_dic.items():
+        mrcs = find_stack(stack_files, stack_name, options.input_star, options.particle_dir)
+        if mrcs is not None:
+            # slice order, so each stack is read front to back
+            stack_particles.append((mrcs, sorted(particles_selected, key=lambda particle: particle[0])))
+    remaining_particle_count = sum(len(particles_selected) for _, particles_selected in stack_particles)
+    print(f'Found {len(stack_particles)} particle stacks with {remaining_particle_count} particles to process '
+          f'out of {total_particle_count} particles in the star file'
+          + (f' in shard {options.shard[0]}/{options.shard[1]}' if options.shard is not None else ''))
+
+    chunk_size = options.chunk_size
+    if options.angle_bin > 0:
+        angle_bins = {}
+        for mrcs, particles_selected in stack_particles:
+            for slice_number, rotation_angle, shift, group, row in particles_selected:
+                bin_index = angle_bin_index(rotation_angle, options.angle_bin)
+                angle_bins.setdefault((group, bin_index), []).append((mrcs, slice_number, rotation_angle, shift, row))
+                bin_counts[bin_index] = bin_counts.get(bin_index, 0) + 1
+        if bin_counts:
+            print_angle_bin_histogram(bin_counts, options.angle_bin)
+        chunks = [
+            (group, bin_index*options.angle_bin, split_by_stack(particles[i:i+chunk_size]))
+            for (group, bin_index), particles in angle_bins.items()
+            for i in range(0, len(particles), chunk_size)
+        ]
+    else:
+        chunks = interleave_chunks([
+            [(group, None, [(mrcs, particles[i:i+chunk_size])])
+             for group, particles in split_by_group(particles_selected).items()
+             for i in range(0, len(particles), chunk_size)]
+            for mrcs, particles_selected in stack_particles
+        ])
+    return chunks, remaining_particle_count
+
+
+def bounded_imap_unordered(pool, func, tasks, max_in_flight):
+    # like pool.imap_unordered, but takes no more than max_in_flight tasks from the iterator ahead of the results,
+    # so neither the task list nor the finished results can pile up in memory
+    results = queue.Queue()
+    in_flight = 0
+    for task in tasks:
+        pool.apply_async(func, (task,), callback=results.put, error_callback=results.put)
+        in_flight += 1
+        while in_flight >= max_in_flight or (in_flight > 0 and not results.empty()):
+            result = results.get()
+            in_flight -= 1
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+    while in_flight > 0:
+        result = results.get()
+        in_flight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+
+def timed_iter(iterable, stage_times, stage):
+    # adds the time every next() on iterable takes to a stage, e.g. reading and chunking the star file in streaming mode
+    iterator = iter(iterable)
+    while True:
+        start_time = time.perf_counter()
+        item = next(iterator, None)
+        add_stage_time(stage_times, stage, start_time)
+        if item is None:
+            return
+        yield item
+
+
+def format_duration(seconds):
+    if not math.isfinite(seconds):
+        return '?'
+    return f'{int(seconds//3600)}:{int(seconds % 3600//60):02d}:{int(seconds % 60):02d}'
+
+
+class ProgressLine:
+    # a single progress line with the particle rate and ETA. On a terminal it is rewritten in place at most every
+    # second; in a log file a new line is written at most every 30 seconds
+    def __init__(self, total, done=0):
+        self.total = total
+        self.start_done = done
+        self.start_time = time.time()
+        self.last_time = 0
+        self.interactive = sys.stdout.isatty()
+        self.interval = 1 if self.interactive else 30
+
+    def update(self, done, force=False):
+        now = time.time()
+        if not force and now - self.last_time < self.interval:
+            return
+        self.last_time = now
+        rate = (done - self.start_done)/max(now - self.start_time, 1e-9)
+        if self.total is None:
+            line = f'Processed {done} particles, {rate:.0f} particles/s'
+        else:
+            eta = (self.total - done)/rate if rate > 0 else math.inf
+            line = (f'Processed {done} out of {self.total} particles ({100*done/max(self.total, 1):.0f}%), '
+                    f'{rate:.0f} particles/s, ETA {format_duration(eta)}')
+        print(line, end='\r' if self.interactive else '\n', flush=True)
+
+    def finish(self, done):
+        self.update(done, force=True)
+        if self.interactive:
+            print()
+
+
+def average_particles(options, star_table=None, report=None):
+    # runs the whole pass over the particles and returns (PowerSpectrumAccumulator, pixel size); a star_table from
+    # load_star_table can be reused across calls, and timings are added to report if one is given
+    if report is None:
+        report = {}
+    main_stages = report.setdefault('main_stages', {})
+    worker_stages = report.setdefault('worker_stages', {})
+    workers = report.setdefault('workers', {})
+    checkpoint_file = checkpoint_file_name(options)
+    accumulator = PowerSpectrumAccumulator(sum_dtype(options), options.compensated == 1)
+    if options.resume:
+        if os.path.exists(checkpoint_file):
+            accumulator = read_checkpoint(checkpoint_file, options)
+            print(f'Resuming from {checkpoint_file} with {accumulator.process_count()} particles already processed')
+        else:
+            print(f'No checkpoint {checkpoint_file} found, starting from the beginning')
+
+    # star file stack name -> path of the stack, or None if it is missing
+    stack_files = {}
+    bin_counts = {}
+    if options.max_mem is not None:
+        # the streaming mode reads the star file a block of rows at a time instead of loading or caching the whole table
+        star_info = {}
+        # the star file is parsed while the chunks are taken, so its time is part of the chunking stage here
+        block_bytes = star_block_bytes(options.max_mem)
+        particles = stream_star_particles(options.input_star, table_columns(options), star_info, options.rotate, options.group_by,
+                                          options.apply_shifts, options.half_sets, block_bytes)
+        block_rows = None
+        if options.shard is not None:
+            # the shard blocks depend on the number of rows, so the image names are read once before streaming
+            block_rows = shard_block_rows(count_star_rows(options.input_star, block_bytes), options.shard[1])
+        chunks = stream_chunks(particles, stack_files, accumulator.processed_rows, bin_counts, options, block_rows)
+        remaining_particle_count = None
+        print(f'Streaming particles from {options.input_star}')
+    else:
+        start_time = time.perf_counter()
+        if star_table is None:
+            star_table = load_star_table(options.input_star, table_columns(options))
+        star_info = {'ang_pix': float(star_table['ang_pix'])}
+        start_time = add_stage_time(main_stages, 'star_parse', start_time)
+        chunks, remaining_particle_count = table_chunks(star_table, stack_files, accumulator.processed_rows, bin_counts, options)
+        add_stage_time(main_stages, 'chunking', start_time)
+    chunks = timed_iter(chunks, main_stages, 'chunking')
+
+    process_count = accumulator.process_count()
+    # the stacks are only looked up as the chunks are built, so the box size is taken from the stack of the first chunk
+    chunks = iter(chunks)
+    first_chunk = next(chunks, None)
+    max_in_flight = max_chunks_in_flight(first_chunk[2][0][0], options) if first_chunk is not None else 1
+    chunks = itertools.chain([first_chunk] if first_chunk is not None else [], chunks)
+    worker_options = {'pad_factor': options.pad_factor, 'fast_fft': options.fast_fft, 'batch_size': options.batch_size,
+                      'half_plane': options.half_plane, 'read_ahead': options.read_ahead, 'fft_workers': options.fft_workers,
+                      'sum_dtype': sum_dtype(options), 'realspace': options.realspace, 'interp_order': options.interp_order,
+                      'variance': options.variance, 'half_sets': options.half_sets, 'bootstrap': options.bootstrap,
+                      'bootstrap_seed': options.bootstrap_seed}
+    # a thread pool has the same interface; its workers hand back the partial sums of each chunk by reference, and the
+    # main thread merges them into the accumulators as they finish, which keeps checkpoints consistent
+    pool_class = multiprocessing.pool.ThreadPool if options.backend == 'threads' else multiprocessing.Pool
+    result_slots = None
+    tasks = chunks
+    if first_chunk is not None:
+        padded_y_dim, padded_x_dim = padded_shape(first_chunk[2][0][0], options.pad_factor, options.fast_fft)
+        accumulator.padded_x_dim = padded_x_dim
+    if options.backend == 'processes' and first_chunk is not None:
+        # worker processes write their partial sums into shared memory slots instead of pickling them back.
+        # There is one slot per chunk in flight, so a free slot is always there when the next chunk is handed out
+        fft_shape = (padded_y_dim, padded_x_dim//2 + 1) if options.half_plane == 1 else (padded_y_dim, padded_x_dim)
+        rotated_shape = (padded_y_dim, padded_x_dim) if options.realspace == 1 else None
+        replicates = replicate_count(options.half_sets, options.bootstrap)
+        slot_bytes = (np.dtype(sum_dtype(options)).itemsize*((1 + replicates)*np.prod(fft_shape) +
+                                                             options.realspace*padded_y_dim*padded_x_dim)
+                      + options.variance*8*np.prod(fft_shape))
+        result_block = shared_memory.SharedMemory(create=True, size=int(max_in_flight*slot_bytes))
+        worker_options['result_slots'] = (result_block.name, max_in_flight, fft_shape, rotated_shape, sum_dtype(options),
+                                          options.variance, replicates)
+        result_block, result_slots = attach_result_slots(*worker_options['result_slots'])
+        free_slots = list(range(max_in_flight))
+        tasks = ((free_slots.pop(), chunk) for chunk in chunks)
+    # particles of missing stacks are never processed, so the progress and ETA count only the ones that were found
+    progress = ProgressLine(None if remaining_particle_count is None else process_count + remaining_particle_count, process_count)
+    start_time = time.time()
+    last_checkpoint_time = time.time()
+    try:
+        with pool_class(processes=options.processes, initializer=init_worker, initargs=(worker_options,)) as pool:
+            worker_function = process_particles if result_slots is None else process_particles_to_slot
+            for result in bounded_imap_unordered(pool, worker_function, tasks, max_in_flight):
+                if result_slots is None:
+                    group, chunk_sums, processed, timings = result
+                else:
+                    group, slot, processed, timings = result
+                    chunk_sums = result_slots.slot(slot, len(processed))
+                chunk_stages, bytes_read, worker = timings
+                for stage, stage_time in chunk_stages.items():
+                    worker_stages[stage] = worker_stages.get(stage, 0) + stage_time
+                worker_report = workers.setdefault(worker, {'busy_time': 0, 'chunks': 0, 'particles': 0})
+                worker_report['busy_time'] += sum(chunk_stages.values())
+                worker_report['chunks'] += 1
+                worker_report['particles'] += len(processed)
+                report['bytes_read'] = report.get('bytes_read', 0) + bytes_read
+                accumulate_start_time = time.perf_counter()
+                # the replicate weights are drawn again from the rows, which is much cheaper than passing them back
+                half_set = None
+                if options.half_sets == 1:
+                    group, half_set = group
+                if chunk_sums.replicate_sum is not None:
+                    chunk_sums.replicate_weights = replicate_weights(processed, half_set, options.half_sets, options.bootstrap,
+                                                                     options.bootstrap_seed).sum(axis=1, dtype=np.float64)
+                accumulator.add(group, chunk_sums, processed)
+                add_stage_time(main_stages, 'accumulate', accumulate_start_time)
+                if result_slots is not None:
+                    free_slots.append(slot)
+                process_count += len(processed)
+                progress.update(process_count)
+                if options.checkpoint_interval > 0 and time.time() - last_checkpoint_time > options.checkpoint_interval:
+                    write_checkpoint(checkpoint_file, accumulator, options)
+                    last_checkpoint_time = time.time()
+    finally:
+        # the shared memory block outlives the processes unless it is unlinked, so this also runs after an error
+        if result_slots is not None:
+            result_slots = chunk_sums = None
+            result_block.close()
+            result_block.unlink()
+
+    progress.finish(process_count)
+    main_stages['processing'] = main_stages.get('processing', 0) + time.time() - start_time
+    if options.max_mem is not None and bin_counts:
+        print_angle_bin_histogram(bin_counts, options.angle_bin)
+    io_wait_time = worker_stages.get('read', 0)
+    compute_time = sum(worker_stages.values()) - io_wait_time
+    if io_wait_time + compute_time > 0:
+        print(f'Processing took {time.time() - start_time:.1f} s; summed over the workers, {compute_time:.1f} s computing and '
+              f'{io_wait_time:.1f} s waiting for particle reads ({100*io_wait_time/(io_wait_time + compute_time):.0f}% I/O wait)')
+    if not accumulator.sums and options.shard is None:
+        # a shard may have no particles of its own; its empty partial sums still complete the set for merge
+        raise AveragingError(f'No particles of {options.input_star} could be read')
+    return accumulator, star_info.get('ang_pix', 1)
+
+
+def symmetrize_fft(fft_average):
+    ydim = fft_average.shape[0]
     fft_sym = (fft_average[1::1, 1::1] + fft_average[-1:0:-1, 1::1] + fft_average[1::1, -1:0:-1] + fft_average[-1:0:-1, -1:0:-1])/4
     fft_sym = np.vstack((fft_average[0, 1::], fft_sym))
     fft_sym = np.hstack((fft_average[:, 0].reshape(ydim, 1), fft_sym))
-    fft_average = fft_sym
-
-x_ang = ang_pix*fft_average.shape[1]
-y_ang = ang_pix*fft_average.shape[0]
-with mrcfile.new(output_mrc, overwrite=True) as f:
-    f.set_data(fft_average.astype('float32'))
-    f.header.cella = (x_ang, y_ang, 0)
-    print(f'\nSaved average power spectrum for {process_count} particles')
-
-
-# Save average rotated real-space image
-output_rotated_mrc = star_file_name.split('.')[0]
-output_rotated_mrc = f'{output_rotated_mrc}_pad{pad_factor}_oversample{oversample_factor}_average_rotated_realspace.mrc'
-rotated_average = rotated_stack / process_count
-with mrcfile.new(output_rotated_mrc, overwrite=True) as f:
-    f.set_data(rotated_average.astype('float32'))
-    f.header.cella = (x_ang, y_ang, 0)
-    print(f'Saved average rotated real-space image for {process_count} particles')
-
-fig, ax = plt.subplots()
-ax.imshow(fft_average)
-plt.tight_layout()
-plt.show()
\ No newline at end of file
+    return fft_sym
+
+
+def oversample_power_spectrum(fft_average, oversample_factor, symmetrize=0):
+    # spline zoom is linear, so oversampling the average gives the same result as oversampling every particle
+    if oversample_factor > 1:
+        fft_average = ndimage.zoom(fft_average, oversample_factor)
+    if symmetrize == 1:
+        fft_average = symmetrize_fft(fft_average)
+    return fft_average
+
+
+def write_mrc(file_name, data, ang_pix):
+    # 3D data is written as an image stack, one image per group
+    x_ang = ang_pix*data.shape[-1]
+    y_ang = ang_pix*data.shape[-2]
+    with mrcfile.new(file_name, overwrite=True) as f:
+        f.set_data(data.astype('float32'))
+        if data.ndim == 3:
+            f.set_image_stack()
+        f.header.cella = (x_ang, y_ang, 0)
+
+
+def subtract_radial_average(fft_average):
+    # the power spectrum minus its average over rings around the DC term, which removes the smooth fall-off of the
+    # amplitudes that both half sets share whether or not they have layer lines
+    y_dim, x_dim = fft_average.shape
+    y, x = np.indices(fft_average.shape)
+    radius = np.rint(np.hypot((y - y_dim//2)/y_dim, (x - x_dim//2)/x_dim)*max(y_dim, x_dim)).astype(np.int64)
+    ring_averages = np.bincount(radius.ravel(), fft_average.ravel())/np.maximum(np.bincount(radius.ravel()), 1)
+    return fft_average - ring_averages[radius]
+
+
+def layer_line_correlation(fft_half1, fft_half2):
+    # correlation of the two half-set power spectra along every row (layer line) from the equator up, like an FSC over
+    # layer lines instead of rings: the rows of reproducible layer lines correlate, rows with only noise do not
+    center = fft_half1.shape[0]//2
+    rows1 = subtract_radial_average(fft_half1)[center:]
+    rows2 = subtract_radial_average(fft_half2)[center:]
+    rows1 = rows1 - rows1.mean(axis=1, keepdims=True)
+    rows2 = rows2 - rows2.mean(axis=1, keepdims=True)
+    norm = np.sqrt((rows1**2).sum(axis=1)*(rows2**2).sum(axis=1))
+    return np.divide((rows1*rows2).sum(axis=1), norm, out=np.zeros(len(norm)), where=norm > 0)
+
+
+def write_layer_line_correlation(file_name, groups, fft_half_averages, ang_pix, group_by=None):
+    # one line per layer line with its spatial frequency and the half-set correlation of every group
+    correlations = [layer_line_correlation(fft_half1, fft_half2) for fft_half1, fft_half2 in fft_half_averages]
+    y_dim = fft_half_averages[0][0].shape[0]
+    with open(file_name, 'w') as f:
+        columns = ['correlation'] if group_by is None else [f'{group_by}_{group}' for group in groups]
+        f.write('layer_line\tfrequency (1/A)\tresolution (A)\t' + '\t'.join(columns) + '\n')
+        for layer_line in range(len(correlations[0])):
+            frequency = layer_line/(y_dim*ang_pix)
+            resolution = f'{1/frequency:.2f}' if layer_line > 0 else 'inf'
+            f.write(f'{layer_line}\t{frequency:.5f}\t{resolution}\t'
+                    + '\t'.join(f'{correlation[layer_line]:.4f}' for correlation in correlations) + '\n')
+
+
+def write_averages(accumulator, ang_pix, options, report=None):
+    # writes the power spectra for every oversampling factor and, unless disabled, the real-space averages; returns the power spectrum
+    # of the first group at the last oversampling factor, for display. The oversampling and writing times go into the report
+    stage_times = report.setdefault('main_stages', {}) if report is not None else None
+    base = f'{output_base(options)}_pad{options.pad_factor}'
+    oversample_factors = options.oversample_factor
+    group_by = options.group_by
+    groups = accumulator.groups()
+    process_count = accumulator.process_count()
+    start_time = time.perf_counter()
+    averages = [accumulator.average(group, options.half_plane) for group in groups]
+    fft_averages = [fft_average for fft_average, _ in averages]
+    rotated_averages = [rotated_average for _, rotated_average in averages]
+    fft_averages_oversampled = {
+        oversample_factor: np.array([oversample_power_spectrum(fft_average, oversample_factor, options.symmetrize)
+                                     for fft_average in fft_averages])
+        for oversample_factor in oversample_factors
+    }
+    # the standard deviation and SNR maps and the half-set and bootstrap power spectra are oversampled the same way as
+    # the averages; each is a stack with one map per group, or group by group all bootstrap replicates
+    fft_stds = [accumulator.standard_deviation(group, options.half_plane) for group in groups]
+    fft_replicate_averages = [accumulator.replicate_averages(group, options.half_plane) for group in groups]
+    power_spec_maps = {oversample_factor: {} for oversample_factor in oversample_factors}
+    for oversample_factor in oversample_factors:
+        maps = power_spec_maps[oversample_factor]
+        if fft_stds[0] is not None:
+            maps['std'] = np.array([oversample_power_spectrum(fft_std, oversample_factor, options.symmetrize) for fft_std in fft_stds])
+            maps['snr'] = np.divide(fft_averages_oversampled[oversample_factor], maps['std'],
+                                    out=np.zeros_like(maps['std']), where=maps['std'] > 0)
+        if fft_replicate_averages[0] is not None:
+            replicate_maps = np.array([[oversample_power_spectrum(fft_average, oversample_factor, options.symmetrize)
+                                        for fft_average in group_averages] for group_averages in fft_replicate_averages])
+            if options.half_sets == 1:
+                maps['half1'], maps['half2'] = replicate_maps[:, 0], replicate_maps[:, 1]
+            if options.bootstrap > 0:
+                maps['bootstrap'] = replicate_maps[:, 2*options.half_sets:].reshape((-1,) + replicate_maps.shape[2:])
+    start_time = add_stage_time(stage_times, 'zoom', start_time)
+    map_descriptions = {'std': 'standard deviation', 'snr': 'SNR', 'half1': 'half set 1', 'half2': 'half set 2',
+                        'bootstrap': f'{options.bootstrap} bootstrap'}
+
+    if group_by is None:
+        for oversample_factor in oversample_factors:
+            write_mrc(f'{base}_oversample{oversample_factor}_average_power_spec.mrc', fft_averages_oversampled[oversample_factor][0], ang_pix)
+            print(f'\nSaved average power spectrum (oversampled {oversample_factor}x) for {process_count} particles')
+            for name, power_spec_map in power_spec_maps[oversample_factor].items():
+                if name == 'bootstrap':
+                    write_mrc(f'{base}_oversample{oversample_factor}_bootstrap_power_spec.mrcs', power_spec_map, ang_pix)
+                else:
+                    write_mrc(f'{base}_oversample{oversample_factor}_{name}_power_spec.mrc', power_spec_map[0], ang_pix)
+            if power_spec_maps[oversample_factor]:
+                print(f'Saved the {", ".join(map_descriptions[name] for name in power_spec_maps[oversample_factor])} '
+                      f'power spectra (oversampled {oversample_factor}x)')
+
+        # Save average rotated real-space image
+        if options.realspace == 1:
+            write_mrc(f'{base}_oversample{oversample_factors[0]}_average_rotated_realspace.mrc', rotated_averages[0], ang_pix)
+            print(f'Saved average rotated real-space image for {process_count} particles')
+    else:
+        for oversample_factor in oversample_factors:
+            write_mrc(f'{base}_oversample{oversample_factor}_{group_by}_average_power_spec.mrcs',
+                      fft_averages_oversampled[oversample_factor], ang_pix)
+            print(f'\nSaved {len(groups)} average power spectra (oversampled {oversample_factor}x), one per {group_by}')
+            for name, power_spec_map in power_spec_maps[oversample_factor].items():
+                write_mrc(f'{base}_oversample{oversample_factor}_{group_by}_{name}_power_spec.mrcs', power_spec_map, ang_pix)
+            if power_spec_maps[oversample_factor]:
+                print(f'Saved the {", ".join(map_descriptions[name] for name in power_spec_maps[oversample_factor])} '
+                      f'power spectra of the {len(groups)} groups (oversampled {oversample_factor}x)')
+
+        if options.realspace == 1:
+            write_mrc(f'{base}_oversample{oversample_factors[0]}_{group_by}_average_rotated_realspace.mrcs',
+                      np.array(rotated_averages), ang_pix)
+            print(f'Saved {len(groups)} average rotated real-space images, one per {group_by}')
+
+        group_list_file = f'{base}_{group_by}_groups.txt'
+        with open(group_list_file, 'w') as f:
+            f.write(f'slice\t{group_by}\tparticles\n')
+            for slice_number, group in enumerate(groups, 1):
+                f.write(f'{slice_number}\t{group}\t{accumulator.sums[group].count}\n')
+                print(f'Slice {slice_number}: {group_by} {group}, {accumulator.sums[group].count} particles')
+        print(f'Saved the list of groups in the stack to {group_list_file}')
+    if options.half_sets == 1:
+        correlation_file = f'{base}{"_" + group_by if group_by is not None else ""}_half_set_layer_line_correlation.txt'
+        write_layer_line_correlation(correlation_file, groups, [fft_averages[:2] for fft_averages in fft_replicate_averages],
+                                     ang_pix, group_by)
+        print(f'Saved the layer-line correlation between the half sets to {correlation_file}')
+    add_stage_time(stage_times, 'write', start_time)
+    return fft_averages_oversampled[oversample_factors[-1]][0]
+
+
+def peak_rss():
+    # peak resident memory of this process and of the largest finished worker process, in bytes
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale)
+
+
+def write_run_report(report, accumulator, options, wall_time):
+    # adds the throughput, utilisation and memory figures to the report, writes it as JSON next to the outputs and
+    # prints a summary
+    process_count = accumulator.process_count()
+    processing_time = report['main_stages'].get('processing', 0)
+    for worker_report in report['workers'].values():
+        worker_report['utilisation'] = worker_report['busy_time']/processing_time if processing_time > 0 else 0
+    main_rss, worker_rss = peak_rss()
+    report.update({
+        'star_file': options.input_star,
+        'options': vars(options),
+        'particles': process_count,
+        'wall_time': wall_time,
+        'particles_per_second': process_count/processing_time if processing_time > 0 else None,
+        'bytes_read_per_second': report.get('bytes_read', 0)/processing_time if processing_time > 0 else None,
+        'peak_rss_bytes': main_rss,
+        'peak_worker_rss_bytes': worker_rss,
+    })
+    report_file = run_report_file_name(options)
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f'\nWall time {wall_time:.1f} s for {process_count} particles')
+    print('Main process stages (s): ' + ', '.join(f'{stage} {stage_time:.2f}' for stage, stage_time in report['main_stages'].items()))
+    print('Worker stages, summed over the workers (s): '
+          + ', '.join(f'{stage} {stage_time:.2f}' for stage, stage_time in report['worker_stages'].items()))
+    if processing_time > 0:
+        print(f'{report["particles_per_second"]:.1f} particles/s, {report["bytes_read_per_second"]/1024**2:.1f} MB/s read')
+    for worker, worker_report in sorted(report['workers'].items()):
+        print(f'{worker}: {worker_report["chunks"]} chunks, {worker_report["particles"]} particles, '
+              f'{100*worker_report["utilisation"]:.0f}% busy')
+    if main_rss is not None:
+        print(f'Peak memory: {main_rss/1024**2:.0f} MB in the main process, {worker_rss/1024**2:.0f} MB in the largest worker process')
+    print(f'Saved the run report to {report_file}')
+
+
+def build_merge_parser():
+    parser = argparse.ArgumentParser(prog='Average_power_spec_calc_v05.py merge', description="""
+Add up the partial sums files written by --shard runs and write the average power spectrum and real-space image,
+as a single run over the whole star file would.
+                        """)
+    parser.add_argument('partial_sums_files', nargs='+', type=str, help='_partial_sums.npz files of the shards')
+    parser.add_argument('-o', '--oversample_factor', default=[1], type=int, nargs='+', help='oversample FFT by this factor')
+    parser.add_argument('-s', '--symmetrize', default=0, type=int, choices=[0, 1], help='Set to 1 to not symmetrize the power spectrum')
+    return parser
+
+
+def merge_main(argv):
+    merge_options = build_merge_parser().parse_args(argv)
+    try:
+        accumulator, ang_pix, metadata = merge_partial_sums(merge_options.partial_sums_files)
+        # the averages are named and written as by an unsharded run on the same star file
+        options = make_options(str(metadata['input_star']), group_by=metadata['group_by'],
+                               oversample_factor=merge_options.oversample_factor, symmetrize=merge_options.symmetrize,
+                               **{name: metadata[f'option_{name}'].item() for name in merge_option_names})
+        print(f'Merged {len(merge_options.partial_sums_files)} partial sums files with {accumulator.process_count()} particles')
+        fft_average_oversampled = write_averages(accumulator, ang_pix, options)
+    except AveragingError as e:
+        sys.exit(str(e))
+    return fft_average_oversampled
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['merge']:
+        fft_average_oversampled = merge_main(argv[1:])
+    else:
+        options = build_parser().parse_args(argv)
+        start_time = time.time()
+        report = {}
+        try:
+            accumulator, ang_pix = average_particles(options, report=report)
+            if options.shard is not None:
+                write_partial_sums(accumulator, ang_pix, options)
+            else:
+                fft_average_oversampled = write_averages(accumulator, ang_pix, options, report)
+        except AveragingError as e:
+            sys.exit(str(e))
+        if options.profile:
+            write_run_report(report, accumulator, options, time.time() - start_time)
+
+        checkpoint_file = checkpoint_file_name(options)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        if options.shard is not None:
+            # shards run unattended, so nothing is shown until the merge
+            return
+
+    fig, ax = plt.subplots()
+    ax.imshow(fft_average_oversampled)
+    plt.tight_layout()
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
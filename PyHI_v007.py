@@ -19,6 +19,7 @@ import matplotlib.backends.backend_qt5agg as plt_qtbackend
 import mrcfile
 from scipy.optimize import minimize
 from scipy import ndimage, spatial, special, signal
+import scipy.fft
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -94,6 +95,8 @@ class MainWindow(QMainWindow):
 
         # Tab1 default Parameters
         self.origin = [0,0]
+        self.fft_xdim = 0
+        self.fft_ydim = 0
         self.tab1_LL = []
         self.tab1_LL_label = []
 
@@ -294,6 +297,13 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.twoD_inv_toggle, 3, 1, 1, 1)
         self.twoD_inv_toggle.setToolTip('Invert black and white of the 2D image')
 
+        self.fast_fft_toggle = QCheckBox('Fast FFT')
+        self.fast_fft_toggle.setEnabled(False)
+        layout.addWidget(self.fast_fft_toggle, 2, 2, 1, 1)
+        self.fast_fft_toggle.setToolTip('''Pad the 2D image with zeros to the next box size with only small prime factors
+        before the FFT, which is much faster for box sizes such as 454 or 502.
+        The power spectrum is then sampled slightly finer; distances in it are converted with its own size''')
+
         self.ps_cmap_toggle = QCheckBox('Invert PS')
         self.ps_cmap_toggle.setCheckable(False)
         layout.addWidget(self.ps_cmap_toggle, 3, 2, 1, 1)
@@ -777,6 +787,8 @@ class MainWindow(QMainWindow):
 
         self.img_xdim = self.mrc_data_array.shape[2]
         self.img_ydim = self.mrc_data_array.shape[1]
+        self.fft_xdim = self.img_xdim
+        self.fft_ydim = self.img_ydim
         self.origin[0] = self.img_xdim/2
         self.origin[1] = self.img_ydim/2
         self.reset_tab1_display()
@@ -827,6 +839,8 @@ class MainWindow(QMainWindow):
 
         self.img_xdim = self.mrc_data_array.shape[2]
         self.img_ydim = self.mrc_data_array.shape[1]
+        self.fft_xdim = self.img_xdim
+        self.fft_ydim = self.img_ydim
         self.origin[0] = self.img_xdim/2
         self.origin[1] = self.img_ydim/2
         self.reset_tab1_display()
@@ -881,6 +895,8 @@ class MainWindow(QMainWindow):
         self.current_img_fft_phase = np.zeros_like(self.current_img_fft_amp)
         self.img_xdim = self.current_img_fft_amp.shape[2]
         self.img_ydim = self.current_img_fft_amp.shape[1]
+        self.fft_xdim = self.img_xdim
+        self.fft_ydim = self.img_ydim
         self.origin[0] = self.img_xdim/2
         self.origin[1] = self.img_ydim/2
 
@@ -928,7 +944,8 @@ class MainWindow(QMainWindow):
                 name = name + ext
             
             with open(name, 'w') as f:
-                f.write(f'{"Angpix:":20s}{self.angpix:10.2f}\n\n')
+                f.write(f'{"Angpix:":20s}{self.angpix:10.2f}\n')
+                f.write(f'{"Fast FFT:":20s}{int(self.fast_fft_toggle.isChecked()):10d}\n\n')
                 f.write(f'{"Origin X:":20s}{self.origin[0]:10.2f}\n')
                 f.write(f'{"Origin Y:":20s}{self.origin[1]:10.2f}\n\n')
                 f.write(f'{"Layerline distance:":20s}{self.LL_distance:10.2f}\n\n')
@@ -967,6 +984,9 @@ class MainWindow(QMainWindow):
                         else:
                             para_dict[name] = float(para)
         try:
+            # the origin is given in the power spectrum of the padded image if Fast FFT was on
+            if 'Fast FFT' in para_dict and self.power_spec_only == 0:
+                self.fast_fft_toggle.setChecked(para_dict['Fast FFT'] == 1)
             self.origin[0] = para_dict['Origin X']         
             self.origin[1] = para_dict['Origin Y']         
             angpix = para_dict['Angpix']
@@ -1079,12 +1099,14 @@ class MainWindow(QMainWindow):
         if self.power_spec_only == 0:
             self.auto_align_toggle.setCheckable(True)
             self.twoD_inv_toggle.setCheckable(True)
+            self.fast_fft_toggle.setEnabled(True)
             self.img_shift_chooser.setEnabled(True)
             self.slice_chooser.setMaximum(self.mrc_data_array.shape[0])
             self.img_shift_chooser.setRange(-self.img_xdim, self.img_xdim)
         elif self.power_spec_only == 1:
             self.auto_align_toggle.setCheckable(False)
             self.twoD_inv_toggle.setCheckable(False)
+            self.fast_fft_toggle.setEnabled(False)
             self.img_shift_chooser.setEnabled(False)
             self.slice_chooser.setMaximum(self.current_img_fft_amp.shape[0])
             self.tab1_buttons_col2['Measure'].setEnabled(False)
@@ -1221,10 +1243,31 @@ class MainWindow(QMainWindow):
             self.draw_tab1_fft()
 
     def calculate_fft(self, img_array):
+        if self.fast_fft_toggle.isChecked():
+            # pad to the next fast FFT size, keeping the image centre at the centre of the padded box
+            fft_ydim = scipy.fft.next_fast_len(img_array.shape[0])
+            fft_xdim = scipy.fft.next_fast_len(img_array.shape[1])
+            pad_y = fft_ydim//2 - img_array.shape[0]//2
+            pad_x = fft_xdim//2 - img_array.shape[1]//2
+            img_array = np.pad(img_array, ((pad_y, fft_ydim - img_array.shape[0] - pad_y), (pad_x, fft_xdim - img_array.shape[1] - pad_x)))
+        fft_resized = img_array.shape != (self.fft_ydim, self.fft_xdim)
+        if fft_resized:
+            self.fft_ydim, self.fft_xdim = img_array.shape
+            self.origin[0] = self.fft_xdim/2
+            self.origin[1] = self.fft_ydim/2
+            self.clear_tab1_LL()
+            if self.tab1_fft_shown is not None:
+                self.tab1_fft_shown.remove()
+                self.tab1_fft_shown = None
+            if self.tab2_fft_shown is not None:
+                self.tab2_fft_shown.remove()
+                self.tab2_fft_shown = None
         current_img_fft = np.fft.fftshift(np.fft.fft2(img_array))
         self.current_img_fft_amp = np.abs(current_img_fft)
         self.current_img_fft_phase = np.angle(current_img_fft)
         self.draw_tab1_fft()    
+        if fft_resized and self.tab1_LL_draw_on:
+            self.draw_tab1_LL()
     
     def draw_tab1_fft(self):
         if self.power_spec_only == 1:
@@ -1236,8 +1279,8 @@ class MainWindow(QMainWindow):
             self.current_img_fft_amp_rotated = self.current_img_fft_amp
         if self.tab1_fft_shown is None:
             self.tab1_fft_shown = self.tab1_axfft.imshow(self.current_img_fft_amp_rotated, origin='lower')
-            self.tab1_axfft.set_xlim(0, self.img_xdim-1)
-            self.tab1_axfft.set_ylim(0, self.img_ydim-1)
+            self.tab1_axfft.set_xlim(0, self.fft_xdim-1)
+            self.tab1_axfft.set_ylim(0, self.fft_ydim-1)
             self.tab1_fft_toolbar.update()
         else:
             self.tab1_fft_shown.set_data(self.current_img_fft_amp_rotated)
@@ -1269,8 +1312,8 @@ class MainWindow(QMainWindow):
             
             if self.tab2_fft_shown is None: 
                 self.tab2_fft_shown = self.tab2_axfft.imshow(fft_for_tab2, origin='lower')
-                self.tab2_axfft.set_xlim(0, self.img_xdim-1)
-                self.tab2_axfft.set_ylim(0, self.img_ydim-1)
+                self.tab2_axfft.set_xlim(0, self.fft_xdim-1)
+                self.tab2_axfft.set_ylim(0, self.fft_ydim-1)
                 self.tab2_fft_toolbar.update()
             else:
                 self.tab2_fft_shown.set_data(fft_for_tab2)
@@ -1381,9 +1424,9 @@ class MainWindow(QMainWindow):
         self.clear_tab1_LL()
         try: 
             self.LL_distance = float(self.tab1_text_col1['Y_dist'].text())
-            x_label = 2*self.img_xdim/5
+            x_label = 2*self.fft_xdim/5
 
-            for i in range(1, 1+int(self.img_ydim/(self.LL_distance*2))):
+            for i in range(1, 1+int(self.fft_ydim/(self.LL_distance*2))):
                 y = self.origin[1] + i*self.LL_distance
                 self.tab1_LL.append(self.tab1_axfft.axline((self.origin[0], y), slope=0, ls=':', color='orange', linewidth=0.5))
                 if i%5 == 0:
@@ -2211,6 +2254,8 @@ class MainWindow(QMainWindow):
         self.img_shift_chooser.valueChanged.connect(self.set_img_rotation_shift)
         self.auto_align_toggle.toggled.connect(self.auto_align_toggle_signal)
         self.twoD_inv_toggle.toggled.connect(self.calc_current_img_array)
+        self.fast_fft_toggle.toggled.connect(self.calc_current_img_array)
+        self.fast_fft_toggle.toggled.connect(self.draw_tab2_fft)
         self.ps_cmap_toggle.toggled.connect(self.draw_tab1_fft)
         self.ps_cmap_toggle.toggled.connect(self.draw_tab2_fft)
         self.tab1_buttons_col2['Set Angpix'].clicked.connect(self.set_angpix)
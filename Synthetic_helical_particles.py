@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+import argparse
+import json
+import os
+
+# Writes particle stacks of a synthetic helix with known rise and twist, and a matching RELION 3.1 style star file,
+# as a reproducible workload for Average_power_spec_calc_v05.py. The helix is built from Gaussian subunits and
+# projected along z, with its axis along x; every particle is then rotated in plane by its rlnAnglePsi and shifted
+# by minus its rlnOriginX/YAngst, so the averaging script brings all particles back into register.
+
+
+def helical_projection(box, ang_pix, rise, twist, radius, subunit_sigma, axial_offset, phase):
+    # projection of a helix of Gaussian subunits with its axis along x through the box centre; all lengths in Angstrom.
+    # A Gaussian subunit is separable in x and y, so the image is one matrix product of per-subunit profiles
+    coordinates = (np.arange(box) - box//2)*ang_pix
+    half_length = box*ang_pix/2 + 3*subunit_sigma
+    first_subunit = int(np.floor((-half_length - axial_offset)/rise))
+    subunits = np.arange(first_subunit, int(np.ceil((half_length - axial_offset)/rise)) + 1)
+    subunit_x = axial_offset + subunits*rise
+    subunit_y = radius*np.cos(np.deg2rad(phase + subunits*twist))
+    profile_x = np.exp(-(coordinates[np.newaxis, :] - subunit_x[:, np.newaxis])**2/(2*subunit_sigma**2))
+    profile_y = np.exp(-(coordinates[np.newaxis, :] - subunit_y[:, np.newaxis])**2/(2*subunit_sigma**2))
+    return (profile_y.T @ profile_x).astype(np.float32)
+
+
+def psi_angles(rng, n_particles, psi_distribution, psi_sigma):
+    # uniform: any in-plane angle; bimodal: the two polarities of a helix picked along mostly horizontal filaments
+    if psi_distribution == 'uniform':
+        return rng.uniform(-180, 180, n_particles)
+    psi = rng.normal(0, psi_sigma, n_particles) + 180*rng.integers(0, 2, n_particles)
+    return (psi + 180) % 360 - 180
+
+
+def generate_dataset(out_dir, n_particles=2000, box=128, ang_pix=1.5, rise=4.75, twist=-1.2, radius=40, subunit_sigma=6,
+                     psi_distribution='uniform', psi_sigma=10, snr=0.1, max_shift=0, particles_per_stack=100, n_classes=4, seed=0):
+    # writes the stacks to out_dir/Particles and returns the path of the star file; the parameters go into dataset.json
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(out_dir, 'Particles'), exist_ok=True)
+    psi = psi_angles(rng, n_particles, psi_distribution, psi_sigma)
+    origins = rng.uniform(-max_shift, max_shift, (n_particles, 2))
+    signal = helical_projection(box, ang_pix, rise, twist, radius, subunit_sigma, 0, 0)
+    noise_sigma = np.sqrt(signal.var()/snr) if snr > 0 else 0
+    rows = []
+    for stack_number, first_particle in enumerate(range(0, n_particles, particles_per_stack), 1):
+        stack_name = f'Particles/stack_{stack_number:05d}.mrcs'
+        stack_particles = range(first_particle, min(first_particle + particles_per_stack, n_particles))
+        stack = np.empty((len(stack_particles), box, box), dtype=np.float32)
+        for slice_number, particle in enumerate(stack_particles):
+            image = helical_projection(box, ang_pix, rise, twist, radius, subunit_sigma,
+                                       rng.uniform(0, rise), rng.uniform(0, 360))
+            image = ndimage.rotate(image, psi[particle], reshape=False, order=1)
+            # the averaging script shifts by +origin, so the image content is moved by -origin
+            image = ndimage.shift(image, -origins[particle][::-1]/ang_pix, order=1)
+            stack[slice_number] = image + rng.normal(0, noise_sigma, (box, box))
+            rows.append(f'{slice_number + 1:06d}@{stack_name} {psi[particle]:.6f} {rng.integers(1, n_classes + 1)} '
+                        f'{origins[particle][0]:.6f} {origins[particle][1]:.6f} 1 {particle % 2 + 1}')
+        with mrcfile.new(os.path.join(out_dir, stack_name), overwrite=True) as f:
+            f.set_data(stack)
+            f.voxel_size = ang_pix
+
+    star_file_name = os.path.join(out_dir, 'particles.star')
+    with open(star_file_name, 'w') as f:
+        f.write('\n# version 30001\n\ndata_optics\n\nloop_\n_rlnOpticsGroupName #1\n_rlnOpticsGroup #2\n'
+                '_rlnImagePixelSize #3\n_rlnImageSize #4\n_rlnImageDimensionality #5\n')
+        f.write(f'opticsGroup1 1 {ang_pix:.6f} {box} 2\n\n\n# version 30001\n\ndata_particles\n\nloop_\n')
+        f.write('_rlnImageName #1\n_rlnAnglePsi #2\n_rlnClassNumber #3\n_rlnOriginXAngst #4\n_rlnOriginYAngst #5\n'
+                '_rlnOpticsGroup #6\n_rlnRandomSubset #7\n')
+        f.write('\n'.join(rows) + '\n\n')
+    with open(os.path.join(out_dir, 'dataset.json'), 'w') as f:
+        json.dump({'n_particles': n_particles, 'box': box, 'ang_pix': ang_pix, 'rise': rise, 'twist': twist,
+                   'radius': radius, 'subunit_sigma': subunit_sigma, 'psi_distribution': psi_distribution,
+                   'psi_sigma': psi_sigma, 'snr': snr, 'max_shift': max_shift, 'particles_per_stack': particles_per_stack,
+                   'n_classes': n_classes, 'seed': seed}, f, indent=1)
+    return star_file_name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write synthetic helical particle stacks and a matching star file')
+    parser.add_argument('out_dir', type=str, help='directory for the star file, dataset.json and the Particles directory')
+    parser.add_argument('-n', '--n_particles', default=2000, type=int, help='number of particles')
+    parser.add_argument('--box', default=128, type=int, help='box size in pixels')
+    parser.add_argument('--ang_pix', default=1.5, type=float, help='pixel size in Angstrom')
+    parser.add_argument('--rise', default=4.75, type=float, help='helical rise in Angstrom')
+    parser.add_argument('--twist', default=-1.2, type=float, help='helical twist in degrees')
+    parser.add_argument('--radius', default=40, type=float, help='helix radius in Angstrom')
+    parser.add_argument('--subunit_sigma', default=6, type=float, help='width (sigma) of the Gaussian subunits in Angstrom')
+    parser.add_argument('--psi', default='uniform', type=str, choices=['uniform', 'bimodal'], help="""
+distribution of rlnAnglePsi: uniform over all angles, or bimodal around 0 and 180 degrees with --psi_sigma spread
+                        """)
+    parser.add_argument('--psi_sigma', default=10, type=float, help='spread of the bimodal psi distribution in degrees')
+    parser.add_argument('--snr', default=0.1, type=float, help='signal to noise ratio (variance) of the images. Set to 0 for no noise')
+    parser.add_argument('--max_shift', default=0, type=float, help='largest rlnOriginX/YAngst, in Angstrom')
+    parser.add_argument('--particles_per_stack', default=100, type=int, help='number of particles in each .mrcs stack')
+    parser.add_argument('--n_classes', default=4, type=int, help='number of random rlnClassNumber values')
+    parser.add_argument('--seed', default=0, type=int, help='random seed')
+    args = parser.parse_args(argv)
+    star_file_name = generate_dataset(args.out_dir, args.n_particles, args.box, args.ang_pix, args.rise, args.twist, args.radius,
+                                      args.subunit_sigma, args.psi, args.psi_sigma, args.snr, args.max_shift,
+                                      args.particles_per_stack, args.n_classes, args.seed)
+    print(f'Saved {args.n_particles} particles of {args.box} pixels and {star_file_name}')
+
+
+if __name__ == '__main__':
+    main()